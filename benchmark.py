@@ -0,0 +1,306 @@
+from argparse import ArgumentParser
+from time import perf_counter
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import tracemalloc
+from block import Block, MERKLE_VERSION
+from blockchain import Blockchain
+from ledger import Ledger
+from miner import Miner
+from transaction import ED25519, SCHEMES, Transaction
+from utility.codec import CONTENT_TYPE
+from utility.hash_utils import hash_block
+from utility.signature_verifier import NATIVE_ED25519, import_ed25519_key, import_key
+from utility.verification import Verification
+from wallet import Wallet
+
+# Benchmarks run inside a scratch directory since wallets and chains are stored in the working directory.
+# Chains are generated once at the largest size, smaller sizes are prefixes of it.
+
+def make_wallets(count, seed):
+    rng = random.Random(seed)
+    return [Wallet(f'bench-{idx}', rng.randbytes) for idx in range(count)]
+
+def generate_chain(wallets, blocks, txs_per_block, difficulty, seed):
+    rng = random.Random(seed)
+    miner = Miner(1)
+    balances = {}
+    chain = [Block(0, '', [], 100, 0)]
+    for height in range(1, blocks + 1):
+        txs = []
+        for _ in range(txs_per_block):
+            funded = [w for w in wallets if balances.get(w.public_key, 0) >= 1]
+            if len(funded) == 0:
+                break
+            sender = rng.choice(funded)
+            recipient = rng.choice(wallets)
+            amount = rng.randint(1, min(5, balances[sender.public_key]))
+            txs.append(Transaction(sender.public_key, recipient.public_key, sender.sign_tx(sender.public_key, recipient.public_key, amount), amount))
+            balances[sender.public_key] -= amount
+            balances[recipient.public_key] = balances.get(recipient.public_key, 0) + amount
+        miner_wallet = wallets[height % len(wallets)]
+        txs.append(Transaction('MINING', miner_wallet.public_key, '', 10))
+        balances[miner_wallet.public_key] = balances.get(miner_wallet.public_key, 0) + 10
+        # A fixed clock keeps block hashes identical between runs.
+        unmined_block = Block(height, hash_block(chain[-1]), txs, None, height * 600, MERKLE_VERSION)
+        proof = miner.mine(Block.header_prefix(height, unmined_block.previous_hash, unmined_block.merkle_root, unmined_block.timestamp), difficulty)
+        chain.append(Block(height, unmined_block.previous_hash, txs, proof, unmined_block.timestamp, MERKLE_VERSION))
+    return chain
+
+# Signature checks are cached process wide, clear them so every measurement starts cold.
+def reset_caches():
+    Wallet.verifier.results.clear()
+    import_key.cache_clear()
+    import_ed25519_key.cache_clear()
+
+def timed(fn, ops=1, repeat=1):
+    best = None
+    for _ in range(repeat):
+        started = perf_counter()
+        fn()
+        elapsed = perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {
+        'seconds': best,
+        'ops': ops,
+        'ops_per_sec': ops / best if best > 0 else None
+    }
+
+def store_chain(node_id, chain, difficulty, public_key):
+    blockchain = Blockchain(difficulty, public_key, node_id, mining_workers=1)
+    blockchain.chain = list(chain)
+    blockchain.save_data()
+    return blockchain
+
+def bench_size(chain, wallets, args):
+    blocks = len(chain) - 1
+    tx_count = sum(len(block.transactions) for block in chain)
+    node_id = f'bench-chain-{blocks}'
+    public_key = wallets[0].public_key
+    results = {}
+    blockchain = store_chain(node_id, chain, args.difficulty, public_key)
+
+    results['save_data'] = timed(blockchain.save_data, blocks, args.repeat)
+
+    # Every load saves a snapshot, so load_data verifies the full chain each time instead of only the first.
+    def load():
+        reset_caches()
+        blockchain.load_data(full_verify=True)
+    results['load_data'] = timed(load, blocks, args.repeat)
+
+    # Startup from the snapshot the full loads above left behind.
+    def load_snapshot():
+        reset_caches()
+        blockchain.load_data()
+    results['load_data_snapshot'] = timed(load_snapshot, blocks, args.repeat)
+
+    def verify():
+        reset_caches()
+        Verification.verify_chain(args.difficulty, chain, Ledger(), 1)
+    results['verify_chain'] = timed(verify, tx_count, args.repeat)
+
+    pks = [w.public_key for w in wallets]
+    results['get_balance'] = timed(lambda: [blockchain.get_balance(pk) for pk in pks for _ in range(100)], len(pks) * 100, args.repeat)
+
+    # Fresh copies so the memoized hash is computed, then the memoized lookup on the tip.
+    copies = [Block.from_dict(block.to_dict()) for block in chain]
+    results['hash_block_cold'] = timed(lambda: [hash_block(block) for block in copies], len(copies))
+    results['hash_block_tip'] = timed(lambda: [hash_block(chain[-1]) for _ in range(10000)], 10000, args.repeat)
+
+    reset_caches()
+    receiver = Blockchain(args.difficulty, public_key, f'{node_id}-add', mining_workers=1)
+    def add_blocks():
+        for block in chain[1:]:
+            if not receiver.add_block(block.to_dict()):
+                raise RuntimeError(f'add_block rejected block {block.index}')
+    results['add_block'] = timed(add_blocks, blocks)
+
+    results['chain_handler'] = bench_chain_handler(blockchain, args.repeat)
+
+    # Memory of a freshly loaded chain, measured separately since tracemalloc slows everything down.
+    reset_caches()
+    tracemalloc.start()
+    loaded = Blockchain(args.difficulty, public_key, node_id, mining_workers=1)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    memory = {
+        'loaded_bytes': current,
+        'peak_bytes': peak,
+        'bytes_per_tx': current / tx_count if tx_count else None,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+    del loaded
+    return {
+        'blocks': blocks,
+        'transactions': tx_count,
+        'tip_hash': hash_block(chain[-1]),
+        'metrics': results,
+        'memory': memory
+    }
+
+def bench_chain_handler(blockchain, repeat):
+    import node
+    node.blockchain = blockchain
+    client = node.app.test_client()
+    etag = client.get('/chain').headers['ETag']
+    return {
+        'plain': timed(lambda: client.get('/chain'), 1, repeat),
+        'gzip': timed(lambda: client.get('/chain', headers={'Accept-Encoding': 'gzip'}), 1, repeat),
+        'binary': timed(lambda: client.get('/chain', headers={'Accept': CONTENT_TYPE}), 1, repeat),
+        'not_modified': timed(lambda: client.get('/chain', headers={'If-None-Match': etag}), 1, repeat)
+    }
+
+def bench_proof_of_work(difficulties, samples, workers):
+    results = {}
+    miner = Miner(workers)
+    for difficulty in difficulties:
+        attempts = 0
+        started = perf_counter()
+        for sample in range(samples):
+            miner.mine(Block.header_prefix(sample, 'bench', 'bench', sample), difficulty)
+            attempts += miner.attempts
+        elapsed = perf_counter() - started
+        results[str(difficulty)] = {
+            'seconds_per_proof': elapsed / samples,
+            'hashes_per_sec': attempts / elapsed
+        }
+    return results
+
+# Cold verification of the whole chain on 1, 2, 4, ... processes, speedup is against 1.
+def bench_parallel_verify(chain, difficulty, worker_counts, repeat):
+    tx_count = sum(len(block.transactions) for block in chain)
+    results = {}
+    for workers in worker_counts:
+        def verify():
+            reset_caches()
+            if not Verification.verify_chain(difficulty, chain, Ledger(), workers):
+                raise RuntimeError(f'verify_chain failed on {workers} workers')
+        results[str(workers)] = timed(verify, tx_count, repeat)
+    base = results[str(worker_counts[0])]['seconds']
+    for metric in results.values():
+        metric['speedup'] = base / metric['seconds']
+    return results
+
+def default_worker_counts():
+    counts = [1]
+    while counts[-1] * 2 <= (os.cpu_count() or 1):
+        counts.append(counts[-1] * 2)
+    if counts[-1] != os.cpu_count():
+        counts.append(os.cpu_count())
+    return counts
+
+# Bulk signing and cold verification of the same payments under every scheme.
+def bench_signing(count, seed):
+    results = {}
+    for scheme in SCHEMES:
+        wallet = Wallet(f'bench-sign-{scheme}', random.Random(seed).randbytes, scheme)
+        payments = [(f'recipient-{idx}', idx + 1) for idx in range(count)]
+        txs = []
+        def sign():
+            txs[:] = wallet.create_txs(payments)
+        sign_metric = timed(sign, count)
+        def verify():
+            reset_caches()
+            if not all(Wallet.verifier.verify(tx) for tx in txs):
+                raise RuntimeError(f'{scheme} signatures did not verify')
+        results[scheme] = {
+            'sign': sign_metric,
+            'verify': timed(verify, count),
+            'backend': 'cryptography' if scheme == ED25519 and NATIVE_ED25519 else 'pycryptodome',
+            'signature_bytes': len(txs[0].signature) // 2,
+            'public_key_bytes': len(wallet.public_key) // 2
+        }
+    return results
+
+# Metrics that got slower than the baseline by more than tolerance, as (name, ratio).
+def compare(results, baseline, tolerance):
+    regressions = []
+    old_sizes = {entry['blocks']: entry for entry in baseline['sizes']}
+    for entry in results['sizes']:
+        old = old_sizes.get(entry['blocks'])
+        if old is None:
+            continue
+        for name, metric in flatten(entry['metrics']):
+            old_metric = dict(flatten(old['metrics'])).get(name)
+            if old_metric and old_metric['seconds'] > 0:
+                ratio = metric['seconds'] / old_metric['seconds']
+                if ratio > 1 + tolerance:
+                    regressions.append((f'{entry["blocks"]} blocks {name}', ratio))
+    return regressions
+
+def flatten(metrics, prefix=''):
+    for name, metric in metrics.items():
+        if 'seconds' in metric:
+            yield prefix + name, metric
+        else:
+            yield from flatten(metric, f'{prefix}{name}.')
+
+def print_report(results):
+    for entry in results['sizes']:
+        print(f'{entry["blocks"]} blocks, {entry["transactions"]} transactions, {entry["memory"]["loaded_bytes"] / 1024:.0f} KiB loaded')
+        for name, metric in flatten(entry['metrics']):
+            print(f'  {name:<28} {metric["seconds"] * 1000:10.2f} ms  {metric["ops_per_sec"] or 0:12.0f} ops/s')
+    for workers, metric in results['parallel_verify'].items():
+        print(f'verify_chain on {workers} processes: {metric["seconds"] * 1000:.2f} ms, {metric["speedup"]:.2f}x')
+    for scheme, metric in results['signing'].items():
+        print(f'{scheme} ({metric["backend"]}): sign {metric["sign"]["ops_per_sec"]:.0f}/s, verify {metric["verify"]["ops_per_sec"]:.0f}/s, {metric["signature_bytes"]} byte signatures, {metric["public_key_bytes"]} byte keys')
+    for difficulty, metric in results['proof_of_work'].items():
+        print(f'proof_of_work difficulty {difficulty}: {metric["seconds_per_proof"] * 1000:.2f} ms/proof, {metric["hashes_per_sec"]:.0f} H/s')
+
+def main():
+    parser = ArgumentParser(description='Benchmark the node on deterministic synthetic chains.')
+    parser.add_argument('--sizes', default='10,100,500', help='Comma separated chain lengths in blocks')
+    parser.add_argument('--txs-per-block', type=int, default=10)
+    parser.add_argument('--wallets', type=int, default=20)
+    parser.add_argument('--difficulty', type=int, default=2, help='Difficulty the chains are mined at')
+    parser.add_argument('--pow-difficulties', default='1,2,3,4')
+    parser.add_argument('--pow-samples', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=None, help='Mining processes for the proof_of_work runs')
+    parser.add_argument('--verify-workers', help='Comma separated process counts for the parallel verify_chain runs, defaults to 1, 2, 4, ... up to the cores')
+    parser.add_argument('--sign-samples', type=int, default=200, help='Transactions signed and verified per signature scheme')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='bench_output.json')
+    parser.add_argument('--baseline', help='Earlier output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline')
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+    output = os.path.abspath(args.output)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, mode='r') as f:
+            baseline = json.load(f)
+
+    os.chdir(tempfile.mkdtemp(prefix='blockchain-bench-'))
+    wallets = make_wallets(args.wallets, args.seed)
+    chain = generate_chain(wallets, sizes[-1], args.txs_per_block, args.difficulty, args.seed)
+    results = {
+        'meta': {
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'sizes': [bench_size(chain[:size + 1], wallets, args) for size in sizes],
+        'parallel_verify': bench_parallel_verify(chain, args.difficulty, sorted(int(n) for n in args.verify_workers.split(',')) if args.verify_workers else default_worker_counts(), args.repeat),
+        'signing': bench_signing(args.sign_samples, args.seed),
+        'proof_of_work': bench_proof_of_work([int(d) for d in args.pow_difficulties.split(',')], args.pow_samples, args.workers)
+    }
+    with open(output, mode='w') as f:
+        json.dump(results, f, indent=2)
+    print_report(results)
+    print(f'Results written to {output}')
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for name, ratio in regressions:
+            print(f'REGRESSION {name}: {ratio:.2f}x slower than baseline')
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
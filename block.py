@@ -1,12 +1,102 @@
+from functools import lru_cache
 from time import time
+import json
+from transaction import Transaction
+from utility.hash_utils import hash_string_256
+from utility.merkle import merkle_root
 
+# Version 1 blocks hash (and prove) the JSON of all their transactions.
+# Version 2 blocks commit to their transactions through a merkle root, only the fixed size header is hashed.
+LEGACY_VERSION = 1
+MERKLE_VERSION = 2
+# JSON of the most recently served blocks, the rest is rebuilt when asked for.
+JSON_CACHE_SIZE = 1024
+
+# Blocks are immutable once built, so their hash is computed once and kept on the block.
+# The canonical bytes and JSON are not kept, for legacy blocks they are as large as all the transactions.
 class Block:
-    def __init__(self, index, previous_hash, transactions, proof, timestamp=None):
-        self.index = index
-        self.previous_hash = previous_hash
-        self.transactions = transactions
-        self.proof = proof
-        self.timestamp = time() if timestamp is None else timestamp
+    __slots__ = ('index', 'previous_hash', 'transactions', 'proof', 'timestamp', 'version', '_merkle_root', '_hash')
+
+    def __init__(self, index, previous_hash, transactions, proof, timestamp=None, version=LEGACY_VERSION):
+        set_field = object.__setattr__
+        set_field(self, 'index', index)
+        set_field(self, 'previous_hash', previous_hash)
+        set_field(self, 'transactions', tuple(transactions))
+        set_field(self, 'proof', proof)
+        set_field(self, 'timestamp', time() if timestamp is None else timestamp)
+        set_field(self, 'version', version)
+        set_field(self, '_merkle_root', None)
+        set_field(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'Block is immutable, cannot set {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'Block is immutable, cannot delete {name}')
+
+    # Everything in a version 2 header except the proof, this is also the prefix the miner hashes.
+    @staticmethod
+    def header_prefix(index, previous_hash, merkle_root, timestamp):
+        return json.dumps([MERKLE_VERSION, index, previous_hash, merkle_root, timestamp]) + ':'
+
+    @property
+    def merkle_root(self):
+        if self._merkle_root is None:
+            object.__setattr__(self, '_merkle_root', merkle_root([tx.hash for tx in self.transactions]))
+        return self._merkle_root
+
+    # Encode as UTF-8 for sha("Unicode-objects must be encoded before hashing")
+    # Sort keys because dictionaries are unordered.
+    @property
+    def canonical(self):
+        if self.version == MERKLE_VERSION:
+            canonical = self.header_prefix(self.index, self.previous_hash, self.merkle_root, self.timestamp) + str(self.proof)
+        else:
+            canonical = json.dumps({
+                'index': self.index,
+                'previous_hash': self.previous_hash,
+                'transactions': [tx.to_ordered_dict() for tx in self.transactions],
+                'proof': self.proof,
+                'timestamp': self.timestamp
+            }, sort_keys=True)
+        return canonical.encode()
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', hash_string_256(self.canonical))
+        return self._hash
+
+    # The cached values are derived, they are never serialized and are rebuilt on demand after loading.
+    # The merkle root is included for clients, from_dict always recomputes it from the transactions.
+    def to_dict(self):
+        converted_block = {
+            'index': self.index,
+            'previous_hash': self.previous_hash,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'proof': self.proof,
+            'timestamp': self.timestamp,
+            'version': self.version
+        }
+        if self.version == MERKLE_VERSION:
+            converted_block['merkle_root'] = self.merkle_root
+        return converted_block
+
+    # Served as is by /chain, the block never changes so neither does its JSON.
+    # Scans longer than the cache pass cached=False, the blocks are then built without evicting the recent ones.
+    def to_json(self, cached=True):
+        return block_json(self) if cached else json.dumps(self.to_dict())
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(block['index'], block['previous_hash'], [Transaction.from_dict(tx) for tx in block['transactions']], block['proof'], block['timestamp'], block.get('version', LEGACY_VERSION))
+
+    def __reduce__(self):
+        return (Block, (self.index, self.previous_hash, self.transactions, self.proof, self.timestamp, self.version))
 
     def __repr__(self):
-        return f'Index: {self.index}, Previous hash: {self.previous_hash}, Proof: {self.proof}, Timestamp: {self.timestamp}, Transactions: {self.transactions}'
\ No newline at end of file
+        return f'Index: {self.index}, Previous hash: {self.previous_hash}, Proof: {self.proof}, Timestamp: {self.timestamp}, Transactions: {list(self.transactions)}'
+
+@lru_cache(maxsize=JSON_CACHE_SIZE)
+def block_json(block):
+    return json.dumps(block.to_dict())
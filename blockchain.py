@@ -1,186 +1,392 @@
-from functools import reduce
+from functools import partial, reduce
 from hashlib import sha256
 import json
 from collections import OrderedDict
-from block import Block
+from block import Block, MERKLE_VERSION
 from time import time
-from transaction import Transaction
+from transaction import RSA, Transaction
 from utility.verification import Verification
 from utility.hash_utils import hash_block
 from wallet import Wallet
-import requests
+from ledger import Ledger
+from mempool import Mempool
+from miner import Miner
+from utility.merkle import merkle_proof
+from utility.codec import CONTENT_TYPE, CodecError, encode_blocks, decode_blocks, encode_transactions
+from utility.metrics import metrics
+from storage import Storage
+from broadcaster import Broadcaster
+import sqlite3
+from threading import RLock
+
+# Blocks or hashes exchanged per request while syncing with a peer.
+SYNC_PAGE_SIZE = 100
+# Blocks are asked for in the binary encoding, JSON is accepted from older peers.
+SYNC_ACCEPT = f'{CONTENT_TYPE}, application/json;q=0.5'
+# A snapshot of the verified state is written every this many blocks.
+SNAPSHOT_INTERVAL = 100
+
+POW_ATTEMPTS = metrics.counter('blockchain_pow_attempts_total', 'Hashes tried while mining')
+POW_SECONDS = metrics.histogram('blockchain_pow_seconds', 'Time spent on proof of work per block, by outcome')
+POW_HASH_RATE = metrics.gauge('blockchain_pow_hash_rate', 'Hashes per second of the last proof of work')
 
 class Blockchain:
-    def __init__(self, difficulty, public_key, node_id, reward=10):
+    def __init__(self, difficulty, public_key, node_id, reward=10, mining_workers=None, max_mempool_size=10000, max_block_transactions=1000, full_verify=False, verify_workers=None, broadcaster=None):
         self.reward = reward
         self.public_key = public_key
         self.genesis = Block(0,'',[],100,0)
         self.chain = [self.genesis]
+        self.ledger = Ledger()
         self.node_id = node_id
-        self.open_transactions = []
+        self.mempool = Mempool(max_mempool_size)
+        self.max_block_transactions = max_block_transactions
         self.difficulty = difficulty
         self.peer_nodes = set()
         self.resolve_conflicts = False
-        self.load_data()
+        # Every read or change of chain, ledger, mempool and peers goes through this lock.
+        # Proof of work, signature checks and network calls run outside of it.
+        self.lock = RLock()
+        self.miner = Miner(mining_workers)
+        # Processes used to verify long runs of blocks, None means one per core.
+        self.verify_workers = verify_workers
+        self.storage = Storage(node_id)
+        # Everything sent to peers goes through this, the simulator swaps in an in-memory network.
+        self.broadcaster = broadcaster or Broadcaster()
+        self.load_data(full_verify)
     
+    # Rewrites the whole store, day to day changes are appended through self.storage instead.
     def save_data(self):
-        try:
-            with open(f'blockchain-{self.node_id}.txt', mode='w') as f:
-                f.write(json.dumps([block.__dict__ for block in [Block(b.index, b.previous_hash, [tx.__dict__ for tx in b.transactions], b.proof, b.timestamp) for b in self.chain]]))
-                f.write('\n')
-                f.write(json.dumps([tx.__dict__ for tx in self.open_transactions]))
-                f.write('\n')
-                f.write(json.dumps(list(self.peer_nodes)))
-        except IOError:
-            print('Blockchain saving failed.')
+        with self.lock:
+            try:
+                self.storage.save_all(self.chain, self.open_transactions, self.peer_nodes)
+            except sqlite3.Error:
+                print('Blockchain saving failed.')
     
     def mine_block(self, node):
-        proof = self.proof_of_work()
-        # OrderedDict so that the order of the transactions dicrionary will always be the same.
-        reward_transaction = Transaction('MINING', node, '', self.reward)
-        # We copy in case our block will be deined, this way we do not override directly our open_transactions.
-        copied_transactions = self.open_transactions[:]
+        with self.lock:
+            last_block = self.chain[-1]
+            # We copy in case our block will be deined, this way we do not override directly our open_transactions.
+            copied_transactions = self.mempool.take(self.max_block_transactions)
         # Verify block transactions
-        for tx in copied_transactions:
-            if not Wallet.verifty_tx_sign(tx):
+        if not all(Wallet.verifty_tx_signs(copied_transactions)):
+            return False
+        reward_transaction = Transaction('MINING', node, '', self.reward)
+        transactions = copied_transactions + [reward_transaction] # Reward miner transaction
+        # The header is fixed before mining, only the proof changes while we search.
+        unmined_block = Block(last_block.index + 1, hash_block(last_block), transactions, None, version=MERKLE_VERSION)
+        proof = self.proof_of_work(Block.header_prefix(unmined_block.index, unmined_block.previous_hash, unmined_block.merkle_root, unmined_block.timestamp))
+        with self.lock:
+            # Mining was cancelled or a competing block was added while we were mining.
+            if proof is None or last_block is not self.chain[-1]:
                 return False
-        copied_transactions.append(reward_transaction) # Reward miner transaction
-        block = Block(len(self.chain),  hash_block(self.chain[-1]), copied_transactions, proof)
-        self.chain.append(block)
-        self.open_transactions = []
-        self.save_data()
-        converted_block = block.__dict__.copy()
-        converted_block['transactions'] = [tx.__dict__ for tx in converted_block['transactions']]
-        for node in self.peer_nodes:
-            try:
-                resp = requests.post(f'http://{node}/broadcast-block', json={
-                    'block': converted_block
-                })
-                if resp.status_code == 400 or resp.status_code == 500:
-                    print('Block declined, needs resolving')
-                if resp.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                print(f'Peer {node} broadcast-block failed')
-                continue
+            block = Block(unmined_block.index, unmined_block.previous_hash, transactions, proof, unmined_block.timestamp, MERKLE_VERSION)
+            if not self.__store_block(block, copied_transactions):
+                return False
+            self.chain.append(block)
+            self.ledger.apply_block(block)
+            # Transactions that arrived during mining stay open for the next block.
+            self.mempool.remove_many([tx.hash for tx in copied_transactions])
+            self.__maybe_snapshot()
+        self.broadcaster.broadcast(self.get_peer_nodes(), '/broadcast-block', {
+            'block': block.to_dict()
+        }, self.__on_block_broadcast, encode_blocks([block]))
         return block
 
+    # Blocks are stored by height before they are applied, so a failed write leaves neither memory
+    # nor the database with the block instead of a gap that every later height is stored past.
+    def __store_block(self, block, confirmed_transactions):
+        try:
+            self.storage.append_block(block, confirmed_transactions)
+        except (sqlite3.Error, CodecError):
+            print('Block saving failed.')
+            return False
+        return True
+
+    def __on_block_broadcast(self, node, resp):
+        if resp.status_code == 400 or resp.status_code == 500:
+            print(f'Block declined by {node}, needs resolving')
+        if resp.status_code == 409:
+            self.resolve_conflicts = True
+
     # is_receiving == True if it's a broadcast we got.
-    def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False):
-        tx = Transaction(sender, recipient, signature, amount)
-        if Verification.verify_tx(tx, self.get_balance): # Signature + Balance verification
-            self.open_transactions.append(tx)
-            self.save_data()
-            if not is_receiving:
-                for node in self.peer_nodes:
-                    try:
-                        resp = requests.post(f'http://{node}/broadcast-transaction', json={
-                            'sender': sender,
-                            'recipient': recipient,
-                            'amount': amount,
-                            'signature': signature
-                        })
-                        if resp.status_code == 400 or resp.status_code == 500:
-                            print('Transaction declined, needs resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        print(f'Peer {node} broadcast-transaction failed')
-                        continue
-            return True
-        return False
+    def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False, scheme=RSA):
+        tx = Transaction(sender, recipient, signature, amount, scheme)
+        # The signature check is the slow part, do it before taking the lock, verify_tx below then hits the cache.
+        if not Wallet.verifty_tx_sign(tx):
+            return False
+        with self.lock:
+            # Already pending (e.g. a broadcast echoed back to us) or no room left.
+            if tx.hash in self.mempool or self.mempool.is_full():
+                return False
+            if not Verification.verify_tx(tx, self.get_balance): # Signature + Balance verification
+                return False
+            self.mempool.add(tx)
+            self.storage.add_transaction(tx)
+        if not is_receiving:
+            self.broadcaster.broadcast(self.get_peer_nodes(), '/broadcast-transaction', tx.to_dict(), self.__on_transaction_broadcast, encode_transactions([tx]))
+        return True
+
+    def __on_transaction_broadcast(self, node, resp):
+        if resp.status_code == 400 or resp.status_code == 500:
+            print(f'Transaction declined by {node}, needs resolving')
+
+    # Add many transactions at once, returns a status per tx: 'accepted', 'invalid_signature', 'duplicate',
+    # 'insufficient_funds' or 'mempool_full'. Signatures are checked in one batch, balances are checked in
+    # order so every tx sees what earlier ones (from the pool or this batch) already spend.
+    # Accepted transactions are stored in one write and sent to each peer in one request.
+    def add_transactions(self, txs, is_receiving=False):
+        signs = Wallet.verifty_tx_signs(txs)
+        results = []
+        accepted = []
+        with self.lock:
+            for tx, valid in zip(txs, signs):
+                if not valid:
+                    results.append('invalid_signature')
+                elif tx.hash in self.mempool:
+                    results.append('duplicate')
+                elif self.mempool.is_full():
+                    results.append('mempool_full')
+                elif not Verification.verify_tx(tx, self.get_balance):
+                    results.append('insufficient_funds')
+                else:
+                    # The mempool keeps the pending spend of each key, so the next tx is checked against it.
+                    self.mempool.add(tx)
+                    accepted.append(tx)
+                    results.append('accepted')
+            if accepted:
+                self.storage.add_transactions(accepted)
+        if accepted and not is_receiving:
+            self.broadcaster.broadcast(self.get_peer_nodes(), '/broadcast-transactions', {
+                'transactions': [tx.to_dict() for tx in accepted]
+            }, partial(self.__on_transactions_broadcast, accepted), encode_transactions(accepted))
+        return results
+
+    # Peers without the batch endpoint get the transactions one by one.
+    def __on_transactions_broadcast(self, txs, node, resp):
+        if resp.status_code == 404:
+            for tx in txs:
+                self.broadcaster.send(node, '/broadcast-transaction', tx.to_dict(), self.__on_transaction_broadcast, encode_transactions([tx]))
+        elif resp.status_code == 400 or resp.status_code == 500:
+            print(f'Transactions declined by {node}, needs resolving')
 
     def get_balance(self, for_pk=None):
-        # We gain here an array of arrays, like [ [], [1,2] , [3,4] ]. The first is empty because it represent the genesis.
-        # We return received - send + get_open_tx_balance()
+        # Confirmed balance comes from the ledger, we return confirmed + get_open_tx_balance()
         if for_pk == None:
             for_pk = self.public_key
-        return sum([sum([tx.amount for tx in block.transactions if tx.recipient == for_pk]) for block in self.chain]) - sum([sum([tx.amount for tx in block.transactions if tx.sender == for_pk]) for block in self.chain]) + self.__get_open_tx_balance(for_pk)
+        with self.lock:
+            return self.ledger.get_balance(for_pk) + self.__get_open_tx_balance(for_pk)
 
     def __get_open_tx_balance(self, for_pk):
-        return sum([tx.amount for tx in self.open_transactions if tx.recipient == for_pk]) - sum([tx.amount for tx in self.open_transactions if tx.sender == for_pk])
+        return self.mempool.get_balance(for_pk)
 
-    def load_data(self):
-        try:
-            # Load saved blockchain
-            with open(f'blockchain-{self.node_id}.txt', mode='r') as f:
-                file_content = f.readlines()
-                if len(file_content) > 0:
-                    self.chain = json.loads(file_content[0][:-1])  # The [:-1] is to remove the \n
-                    # When we load the json it won't load as OrderedDict so...
-                    self.chain = [Block(block['index'], block['previous_hash'], [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], block['proof'], block['timestamp']) for block in self.chain]
-                    # Same for open transactions
-                    self.open_transactions = json.loads(file_content[1][:-1]) # The [:-1] is to remove the \n
-                    self.open_transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in self.open_transactions]
-                    self.peer_nodes = set(json.loads(file_content[2]))
-
-        except (IOError, IndexError):
+    @property
+    def open_transactions(self):
+        with self.lock:
+            return list(self.mempool)
+
+    # Unless full_verify is set, blocks up to a matching snapshot are trusted and only later ones are verified.
+    def load_data(self, full_verify=False):
+        # Load saved blockchain, blocks are streamed in one row at a time.
+        chain = list(self.storage.load_blocks())
+        if len(chain) > 0:
+            self.chain = chain
+            for tx in self.storage.load_open_transactions():
+                self.mempool.add(tx)
+            self.peer_nodes = set(self.storage.load_peer_nodes())
+        else:
             print('Failed to find blockchain, generated new blockchain file.')
             self.save_data()
 
-        if not Verification.verify_chain(self.get_balance, self.difficulty, self.chain):
+        snapshot = None if full_verify else self.storage.load_snapshot()
+        if snapshot is not None and (snapshot['height'] >= len(self.chain) or hash_block(self.chain[snapshot['height']]) != snapshot['tip_hash']):
+            print('Snapshot does not match the chain, verifying the full chain.')
+            snapshot = None
+        if snapshot is not None:
+            ledger = Ledger.from_snapshot(snapshot['balances'], snapshot['height'])
+            valid = Verification.verify_blocks(self.difficulty, self.chain[snapshot['height']], self.chain[snapshot['height'] + 1:], ledger, self.verify_workers)
+        else:
+            ledger = Ledger()
+            valid = Verification.verify_chain(self.difficulty, self.chain, ledger, self.verify_workers)
+        if not valid:
             print('Invalid chain, please obtain a valid one or clear the file being used.')
             exit()
+        self.ledger = ledger
+        if snapshot is None or self.ledger.height - snapshot['height'] >= SNAPSHOT_INTERVAL:
+            self.save_snapshot()
+
+    def save_snapshot(self):
+        with self.lock:
+            try:
+                self.storage.save_snapshot(self.ledger.height, hash_block(self.chain[self.ledger.height]), self.ledger.balances)
+            except sqlite3.Error:
+                print('Snapshot saving failed.')
+
+    def __maybe_snapshot(self):
+        if self.ledger.height % SNAPSHOT_INTERVAL == 0:
+            self.save_snapshot()
     
-    def proof_of_work(self):
-        proof = 0
-        while not Verification.valid_proof(self.open_transactions, hash_block(self.chain[-1]), proof, self.difficulty):
-            proof += 1
+    def proof_of_work(self, header_prefix):
+        started = time()
+        proof = self.miner.mine(header_prefix, self.difficulty)
+        POW_SECONDS.observe(time() - started, outcome='found' if proof is not None else 'cancelled')
+        POW_ATTEMPTS.inc(self.miner.attempts)
+        POW_HASH_RATE.set(self.miner.hash_rate)
+        print(f'Mining: {self.miner.attempts} hashes at {self.miner.hash_rate:.0f} H/s')
         return proof
 
-    # Conflict resolution
+    # Conflict resolution, peers are asked for their tip only and blocks are fetched from the fork point on.
     def resolve(self):
-        winner_chain = self.chain
-        replace = False
-        for node in self.peer_nodes:
-            try:
-                resp = requests.get(f'http://{node}/chain')
-                node_chain = resp.json()
-                node_chain = [
-                    Block(block['index'], block['previous_hash'], 
-                    [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']], 
-                    block['proof'], 
-                    block['timestamp']) for block in node_chain]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(self.chain)
-                if node_chain_length > local_chain_length and Verification.verify_chain(self.get_balance, self.difficulty, self.chain):
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
+        candidates = []
+        for node in self.get_peer_nodes():
+            resp = self.broadcaster.get(node, '/chain/tip')
+            if resp is None or resp.status_code != 200:
                 continue
+            height = resp.json()['height']
+            if height > self.get_tip().index:
+                candidates.append((height, node))
+        replace = False
+        # Longest first, fall back to the next peer if a chain turns out to be invalid.
+        for height, node in sorted(candidates, reverse=True):
+            if self.sync_from(node, height):
+                replace = True
+                break
         self.resolve_conflicts = False
-        self.chain = winner_chain
-        if replace:
-            self.open_transactions = []
-        self.save_data()
         return replace
 
+    # Walk back from the lowest common height a page of hashes at a time until a hash matches ours.
+    def find_fork_point(self, node, peer_height):
+        chain = self.get_blocks()
+        top = min(chain[-1].index, peer_height)
+        while top >= 0:
+            start = max(0, top - SYNC_PAGE_SIZE + 1)
+            resp = self.broadcaster.get(node, '/chain/hashes', {'from': start, 'limit': top - start + 1})
+            if resp is None or resp.status_code != 200:
+                return None
+            hashes = resp.json()['hashes']
+            for height in range(min(top, start + len(hashes) - 1), start - 1, -1):
+                if hashes[height - start] == hash_block(chain[height]):
+                    return height
+            top = start - 1
+        return None
+
+    def sync_from(self, node, peer_height):
+        fork = self.find_fork_point(node, peer_height)
+        if fork is None:
+            return False
+        with self.lock:
+            fork_block = self.chain[fork]
+            ledger = self.ledger.fork(fork)
+            if ledger is None:
+                # The fork is below the snapshot we started from, rebuild the balances from our (verified) blocks.
+                ledger = Ledger.replay(self.chain[:fork + 1])
+        previous_block = fork_block
+        blocks = []
+        # Fetch and verify the blocks after the fork point in pages.
+        while previous_block.index < peer_height:
+            resp = self.broadcaster.get(node, '/chain', {'from': previous_block.index + 1, 'limit': SYNC_PAGE_SIZE}, {'Accept': SYNC_ACCEPT})
+            if resp is None or resp.status_code != 200:
+                return False
+            try:
+                # Peers that do not speak the binary encoding answer with JSON.
+                if resp.headers.get('Content-Type', '').startswith(CONTENT_TYPE):
+                    page = decode_blocks(resp.content)
+                else:
+                    page = [Block.from_dict(block) for block in resp.json()]
+            except (ValueError, KeyError, TypeError):
+                return False
+            if len(page) == 0 or not Verification.verify_blocks(self.difficulty, previous_block, page, ledger, self.verify_workers):
+                return False
+            blocks.extend(page)
+            previous_block = page[-1]
+        with self.lock:
+            # Our chain may have moved on while we were downloading.
+            if len(self.chain) <= fork or self.chain[fork] is not fork_block or previous_block.index <= self.chain[-1].index:
+                return False
+            try:
+                self.storage.replace_blocks(blocks)
+            except (sqlite3.Error, CodecError):
+                print('Blockchain saving failed.')
+                return False
+            self.chain = self.chain[:fork + 1] + blocks
+            self.ledger = ledger
+            self.miner.cancel()
+            self.mempool.clear()
+            self.save_snapshot()
+            self.storage.clear_transactions()
+        return True
+
+    def get_blocks(self, start=0, limit=None):
+        with self.lock:
+            return self.chain[start:] if limit is None else self.chain[start:start + limit]
+
+    def get_tip(self):
+        with self.lock:
+            return self.chain[-1]
+
+    # block is a Block or its dict form.
     def add_block(self, block):
-        txs = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-        # Check proof is correct and previous hashes matches
-        # The txs[-1] is so to skip our reward tx because we calculate the proof without it.
-        if not Verification.valid_proof(txs[:-1], block['previous_hash'], block['proof'], self.difficulty) or not hash_block(self.chain[-1]) == block['previous_hash']:
+        new_block = block if isinstance(block, Block) else Block.from_dict(block)
+        # Check proof is correct, the [:-1] is to skip the reward tx which carries no signature.
+        if not Verification.valid_block_proof(new_block, self.difficulty) or not all(Wallet.verifty_tx_signs(new_block.transactions[:-1])):
             return False
-        self.chain.append(Block(block['index'], block['previous_hash'], txs, block['proof'], block['timestamp']))
-        
-        # If we got a block with some of our opentx's inside we need to remove these open tx's
-        stored_txs = self.open_transactions[:]
-        for itx in block['transactions']:
-            for opentx in stored_txs:
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
-                    try:
-                        self.open_transactions.remove(opentx)
-                    except ValueError:
-                        print('Item was already removed')
-        self.save_data()
+        with self.lock:
+            # Check previous hashes matches
+            if not hash_block(self.chain[-1]) == new_block.previous_hash:
+                return False
+            # The ledger is snapshotted as verified, so balances are checked here like verify_chain would.
+            if new_block.index != self.chain[-1].index + 1 or not Verification.funded(new_block, self.ledger):
+                return False
+            # Any of our opentx's inside the block leave storage with it.
+            if not self.__store_block(new_block, new_block.transactions):
+                return False
+            self.chain.append(new_block)
+            self.ledger.apply_block(new_block)
+            # A competing block at the height we are mining makes our current work useless.
+            self.miner.cancel()
+            self.mempool.remove_many([tx.hash for tx in new_block.transactions])
+            self.__maybe_snapshot()
         return True
 
+    # A block broadcast by a peer, returns 'added', 'rejected', 'ahead' (we need to resolve) or 'behind'.
+    def receive_block(self, block):
+        index = block.index if isinstance(block, Block) else block['index']
+        tip_index = self.get_tip().index
+        if index == tip_index + 1:
+            # add_block checks the previous hash again under the lock.
+            return 'added' if self.add_block(block) else 'rejected'
+        if index > tip_index:
+            self.resolve_conflicts = True
+            return 'ahead'
+        return 'behind'
+
+    # Inclusion proof of a transaction in the block at height, None if there is nothing to prove against.
+    def get_tx_proof(self, height, tx_hash):
+        with self.lock:
+            if height < 0 or height >= len(self.chain) or self.chain[height].version != MERKLE_VERSION:
+                return None
+            block = self.chain[height]
+        leaves = [tx.hash for tx in block.transactions]
+        if tx_hash not in leaves:
+            return None
+        return {
+            'height': height,
+            'block_hash': block.hash,
+            'merkle_root': block.merkle_root,
+            'tx_hash': tx_hash,
+            'proof': merkle_proof(leaves, leaves.index(tx_hash))
+        }
+
     def add_peer_node(self, node):
-        self.peer_nodes.add(node)
-        self.save_data()
+        with self.lock:
+            self.peer_nodes.add(node)
+            self.storage.add_peer_node(node)
 
     def remove_peer_node(self, node):
-        self.peer_nodes.discard(node)
-        self.save_data()
+        with self.lock:
+            self.peer_nodes.discard(node)
+            self.storage.remove_peer_node(node)
+        self.broadcaster.forget(node)
     
     def get_peer_nodes(self):
-        return list(self.peer_nodes)
\ No newline at end of file
+        with self.lock:
+            return list(self.peer_nodes)
\ No newline at end of file
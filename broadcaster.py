@@ -0,0 +1,98 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep, time
+import requests
+from requests.adapters import HTTPAdapter
+from utility.codec import CONTENT_TYPE
+from utility.metrics import metrics
+
+PEER_SECONDS = metrics.histogram('blockchain_peer_request_seconds', 'Latency of answered peer requests, by peer and path')
+PEER_FAILURES = metrics.counter('blockchain_peer_failures_total', 'Peer requests that got no answer, by peer and path')
+
+# Fans requests out to peers on a thread pool so local callers never wait on the network.
+# Each peer gets its own pooled session, requests time out and connection failures are retried with backoff.
+class Broadcaster:
+    def __init__(self, timeout=3, retries=2, backoff=0.25, workers=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.sessions = {}
+        # peer -> {'sent', 'failed', 'latency'}, latency is of the last successful request in seconds.
+        self.stats = {}
+        self.lock = Lock()
+
+    def session(self, node):
+        with self.lock:
+            if node not in self.sessions:
+                session = requests.Session()
+                session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+                self.sessions[node] = session
+                self.stats[node] = {'sent': 0, 'failed': 0, 'latency': None}
+            return self.sessions[node]
+
+    def forget(self, node):
+        with self.lock:
+            session = self.sessions.pop(node, None)
+            self.stats.pop(node, None)
+        if session is not None:
+            session.close()
+
+    def record(self, node, latency=None):
+        with self.lock:
+            stats = self.stats.get(node)
+            if stats is None:
+                return
+            stats['sent'] += 1
+            if latency is None:
+                stats['failed'] += 1
+            else:
+                stats['latency'] = latency
+
+    # Only connection failures are retried, a timed out request may have been handled already.
+    def request(self, method, node, path, **kwargs):
+        session = self.session(node)
+        for attempt in range(self.retries + 1):
+            started = time()
+            try:
+                resp = session.request(method, f'http://{node}{path}', timeout=self.timeout, **kwargs)
+                latency = time() - started
+                self.record(node, latency)
+                PEER_SECONDS.observe(latency, peer=node, path=path)
+                return resp
+            except requests.exceptions.ConnectionError:
+                self.record(node)
+                PEER_FAILURES.inc(peer=node, path=path)
+                if attempt < self.retries:
+                    sleep(self.backoff * 2 ** attempt)
+            except requests.exceptions.RequestException:
+                self.record(node)
+                PEER_FAILURES.inc(peer=node, path=path)
+                break
+        print(f'Peer {node} {path} failed')
+        return None
+
+    # With data the binary encoding is sent first, peers that cannot read it (400 or 415) get the JSON payload instead.
+    def post(self, node, path, payload, data=None):
+        if data is not None:
+            resp = self.request('POST', node, path, data=data, headers={'Content-Type': CONTENT_TYPE})
+            if resp is None or resp.status_code not in (400, 415):
+                return resp
+        return self.request('POST', node, path, json=payload)
+
+    def get(self, node, path, params=None, headers=None):
+        return self.request('GET', node, path, params=params, headers=headers)
+
+    # on_response(node, resp) runs on the pool for every peer that answered.
+    def broadcast(self, nodes, path, payload, on_response=None, data=None):
+        return [self.executor.submit(self.send, node, path, payload, on_response, data) for node in list(nodes)]
+
+    def send(self, node, path, payload, on_response, data=None):
+        resp = self.post(node, path, payload, data)
+        if resp is not None and on_response is not None:
+            on_response(node, resp)
+        return resp
+
+    def get_stats(self):
+        with self.lock:
+            return {node: stats.copy() for node, stats in self.stats.items()}
@@ -0,0 +1,61 @@
+class Ledger:
+    def __init__(self):
+        # Confirmed balances keyed by public key, height is the index of the last applied block.
+        self.balances = {}
+        self.height = -1
+        # deltas[i] is how block base + 1 + i changed each balance, kept so the ledger can be rolled back to a fork point.
+        # base is -1 unless the ledger was started from a snapshot.
+        self.base = -1
+        self.deltas = []
+        self.current = {}
+
+    @classmethod
+    def from_snapshot(cls, balances, height):
+        ledger = cls()
+        ledger.balances = dict(balances)
+        ledger.height = height
+        ledger.base = height
+        return ledger
+
+    # Rebuild balances from blocks that were already verified, no checks are made.
+    @classmethod
+    def replay(cls, blocks):
+        ledger = cls()
+        for block in blocks:
+            ledger.apply_block(block)
+        return ledger
+
+    def get_balance(self, for_pk):
+        return self.balances.get(for_pk, 0)
+
+    def apply_tx(self, tx):
+        self.balances[tx.sender] = self.get_balance(tx.sender) - tx.amount
+        self.balances[tx.recipient] = self.get_balance(tx.recipient) + tx.amount
+        self.current[tx.sender] = self.current.get(tx.sender, 0) - tx.amount
+        self.current[tx.recipient] = self.current.get(tx.recipient, 0) + tx.amount
+
+    # Close the block whose transactions were just applied.
+    def commit(self, height):
+        self.deltas.append(self.current)
+        self.current = {}
+        self.height = height
+
+    def apply_block(self, block):
+        for tx in block.transactions:
+            self.apply_tx(tx)
+        self.commit(block.index)
+
+    # A new ledger holding the balances as of block height, self is left untouched.
+    # None if height is below the snapshot this ledger started from.
+    def fork(self, height):
+        if height < self.base:
+            return None
+        ledger = Ledger()
+        ledger.balances = self.balances.copy()
+        for delta in self.deltas[height - self.base:]:
+            for pk, amount in delta.items():
+                ledger.balances[pk] -= amount
+        ledger.base = self.base
+        ledger.deltas = self.deltas[:height - self.base]
+        ledger.height = height
+        return ledger
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+
+# Open transactions indexed by tx hash in arrival order, with the pending amount of every key kept up to date.
+class Mempool:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.transactions = OrderedDict()
+        # pk -> received - sent over all open transactions.
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        return iter(list(self.transactions.values()))
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.transactions
+
+    def is_full(self):
+        return len(self.transactions) >= self.max_size
+
+    def get_balance(self, for_pk):
+        return self.pending.get(for_pk, 0)
+
+    def __update_pending(self, tx, sign):
+        self.pending[tx.sender] = self.get_balance(tx.sender) - sign * tx.amount
+        self.pending[tx.recipient] = self.get_balance(tx.recipient) + sign * tx.amount
+        # A set, a transfer to oneself updates the same key twice and must only be dropped once.
+        for pk in {tx.sender, tx.recipient}:
+            if self.pending[pk] == 0:
+                del self.pending[pk]
+
+    # False if the transaction is already pending or the pool is full.
+    def add(self, tx):
+        if tx.hash in self.transactions or self.is_full():
+            return False
+        self.transactions[tx.hash] = tx
+        self.__update_pending(tx, 1)
+        return True
+
+    def remove(self, tx_hash):
+        tx = self.transactions.pop(tx_hash, None)
+        if tx is not None:
+            self.__update_pending(tx, -1)
+        return tx
+
+    # The removed transactions, hashes that were not pending are skipped.
+    def remove_many(self, tx_hashes):
+        return [tx for tx in (self.remove(tx_hash) for tx_hash in tx_hashes) if tx is not None]
+
+    # The oldest limit transactions, left in the pool.
+    def take(self, limit=None):
+        txs = []
+        for tx in self.transactions.values():
+            if limit is not None and len(txs) >= limit:
+                break
+            txs.append(tx)
+        return txs
+
+    def clear(self):
+        self.transactions.clear()
+        self.pending.clear()
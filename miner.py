@@ -0,0 +1,56 @@
+from hashlib import sha256
+from multiprocessing import Event, Process, Queue, cpu_count
+from time import time
+
+# How many nonces a worker tries between checks of the stop event.
+CHECK_EVERY = 10000
+
+def search(prefix, difficulty, start, step, stop):
+    # The prefix (transactions + last hash) never changes, so hash it once and only feed the nonce per attempt.
+    base = sha256(prefix.encode())
+    target = difficulty * '0'
+    proof = start
+    attempts = 0
+    while not stop.is_set():
+        for _ in range(CHECK_EVERY):
+            h = base.copy()
+            h.update(str(proof).encode())
+            attempts += 1
+            if h.hexdigest()[:difficulty] == target:
+                stop.set()
+                return proof, attempts
+            proof += step
+    return None, attempts
+
+def search_worker(prefix, difficulty, start, step, stop, results):
+    results.put(search(prefix, difficulty, start, step, stop))
+
+class Miner:
+    def __init__(self, workers=None):
+        self.workers = workers or cpu_count()
+        self.stop = Event()
+        self.attempts = 0
+        self.hash_rate = 0
+
+    # Returns the proof, or None if mining was cancelled.
+    def mine(self, prefix, difficulty):
+        self.stop.clear()
+        started = time()
+        if self.workers == 1:
+            results = [search(prefix, difficulty, 0, 1, self.stop)]
+        else:
+            # Worker i tries the nonces i, i + workers, i + 2 * workers, ...
+            queue = Queue()
+            procs = [Process(target=search_worker, args=(prefix, difficulty, i, self.workers, self.stop, queue), daemon=True) for i in range(self.workers)]
+            for p in procs:
+                p.start()
+            results = [queue.get() for _ in procs]
+            for p in procs:
+                p.join()
+        self.attempts = sum(attempts for _, attempts in results)
+        self.hash_rate = self.attempts / max(time() - started, 1e-9)
+        proofs = [proof for proof, _ in results if proof is not None]
+        return min(proofs) if proofs else None
+
+    def cancel(self):
+        self.stop.set()
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
+from time import time
+from uuid import uuid4
+
+# Jobs kept around for polling, the oldest finished ones are dropped first.
+MAX_JOBS = 1000
+
+class MiningJob:
+    def __init__(self):
+        self.id = uuid4().hex
+        self.status = 'queued'
+        self.block = None
+        self.message = None
+        self.created = time()
+        self.finished = None
+        self.done = Event()
+
+    def finish(self, status, message, block=None):
+        self.status = status
+        self.message = message
+        self.block = block
+        self.finished = time()
+        self.done.set()
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'message': self.message,
+            'block': None if self.block is None else self.block.to_dict(),
+            'created': self.created,
+            'finished': self.finished
+        }
+
+# Mines on its own thread so HTTP handlers never wait on proof of work.
+# Blocks are mined on request (submit) or, when continuous, whenever the mempool has transactions.
+class MiningWorker:
+    def __init__(self, blockchain, public_key, continuous=False, poll_interval=1.0):
+        self.blockchain = blockchain
+        self.public_key = public_key
+        self.continuous = continuous
+        self.poll_interval = poll_interval
+        self.queue = Queue()
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name='mining-worker', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.blockchain.miner.cancel()
+
+    def submit(self):
+        job = MiningJob()
+        with self.lock:
+            self.jobs[job.id] = job
+            while len(self.jobs) > MAX_JOBS:
+                self.jobs.popitem(last=False)
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.queue.get(timeout=self.poll_interval)
+            except Empty:
+                if self.continuous and len(self.blockchain.mempool) > 0 and not self.blockchain.resolve_conflicts:
+                    self.mine(None)
+                continue
+            self.mine(job)
+
+    def mine(self, job):
+        if job is not None:
+            job.status = 'mining'
+        if self.blockchain.resolve_conflicts:
+            block = None
+            message = 'Resolve conflicts first, block not added'
+        else:
+            # A failure fails this job only, the worker keeps serving the queue.
+            try:
+                block = self.blockchain.mine_block(self.public_key)
+                message = 'Block mined succesfully' if block else 'Adding a block failed.'
+            except Exception as error:
+                print(f'Mining failed: {error!r}')
+                block = None
+                message = f'Mining failed: {error}'
+        if job is not None:
+            job.finish('done' if block else 'failed', message, block or None)
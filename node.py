@@ -1,14 +1,46 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, g, jsonify, request, send_from_directory
 from flask_cors import CORS
 from blockchain import Blockchain
+from block import JSON_CACHE_SIZE
 from wallet import Wallet
+from mining_worker import MiningWorker
+from utility.codec import CONTENT_TYPE, CodecError, encode_blocks, decode_blocks, decode_transactions
+from transaction import RSA, SCHEMES, Transaction
+from utility.metrics import metrics, profiler
 from argparse import ArgumentParser
+from time import perf_counter
+import gzip
+import zlib
 
 app = Flask(__name__)
 CORS(app)
 
 wallet = None
 blockchain = None
+mining_worker = None
+
+# Ranges with more blocks than this are streamed instead of built in memory.
+STREAM_THRESHOLD = 500
+# Most transactions accepted by one batch request.
+MAX_BATCH_SIZE = 1000
+
+REQUEST_SECONDS = metrics.histogram('blockchain_http_request_seconds', 'Time until a handler returns its response (streamed bodies excluded), by method and endpoint')
+REQUESTS = metrics.counter('blockchain_http_requests_total', 'Handled requests, by method, endpoint and status')
+CHAIN_HEIGHT = metrics.gauge('blockchain_chain_height', 'Index of the tip block')
+MEMPOOL_SIZE = metrics.gauge('blockchain_mempool_transactions', 'Open transactions in the mempool')
+PEERS = metrics.gauge('blockchain_peers', 'Known peer nodes')
+
+@app.before_request
+def start_timer():
+    g.started = perf_counter()
+
+@app.after_request
+def record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if 'started' in g:
+        REQUEST_SECONDS.observe(perf_counter() - g.started, method=request.method, endpoint=endpoint)
+    REQUESTS.inc(method=request.method, endpoint=endpoint, status=response.status_code)
+    return response
 
 @app.route('/', methods=['GET'])
 def get_node_ui():
@@ -29,6 +61,7 @@ def load_keys():
         return jsonify({
             'public_key': wallet.public_key,
             'private_key': wallet.private_key,
+            'scheme': wallet.scheme,
             'funds': blockchain.get_balance()
         }), 200
 
@@ -39,42 +72,138 @@ def get_balance(for_pk):
         'balance': blockchain.get_balance(None if for_pk == '' or for_pk == None else for_pk)    
     }), 200
 
+def mining_job_response(job):
+    # ?wait=<seconds> blocks until the job finishes (or the time is up) instead of polling.
+    wait = request.args.get('wait', 0, type=float)
+    if wait > 0:
+        job.done.wait(min(wait, 60))
+    values = job.to_dict()
+    values['funds'] = blockchain.get_balance()
+    values['hash_rate'] = blockchain.miner.hash_rate
+    if job.status == 'done':
+        return jsonify(values), 201
+    if job.status == 'failed':
+        return jsonify(values), 500
+    values['message'] = 'Mining job {}.'.format(job.status)
+    return jsonify(values), 202
+
 @app.route('/mine', methods=['POST'])
 def mine():
     if blockchain.resolve_conflicts:
         return jsonify({
             'message': 'Resolve conflicts first, block not added'
         }), 409
-    block = blockchain.mine_block(wallet.public_key)
-    if block:
-        dict_block = block.__dict__.copy()
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
-        return jsonify({
-            'message': 'Block mined succesfully',
-            'block': dict_block,
-            'funds': blockchain.get_balance()
-        }), 201
-    else:
+    return mining_job_response(mining_worker.submit())
+
+@app.route('/mine/<job_id>', methods=['GET'])
+def get_mining_job(job_id):
+    job = mining_worker.get(job_id)
+    if job is None:
         return jsonify({
-            'message': 'Adding a block failed.'
-        }), 500
+            'message': 'No such mining job.'
+        }), 404
+    return mining_job_response(job)
+
+def chain_chunks(blocks):
+    # A range longer than the JSON cache would only evict it and miss on every block.
+    cached = len(blocks) <= JSON_CACHE_SIZE
+    yield '['
+    for idx, block in enumerate(blocks):
+        if idx > 0:
+            yield ','
+        yield block.to_json(cached)
+    yield ']'
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # 31 means a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
-    snapshot = blockchain.chain[:]
-    dict_chain = [block.__dict__.copy() for block in snapshot]
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [tx.__dict__ for tx in dict_block['transactions']]
-    return jsonify(dict_chain), 200
+    # Optional from/limit select a range of heights, without them the whole chain is returned.
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    snapshot = blockchain.get_blocks(start, None if limit is None else max(limit, 0))
+    # Peers ask for the binary encoding, browsers and older peers get JSON.
+    binary = request.accept_mimetypes.best_match(['application/json', CONTENT_TYPE]) == CONTENT_TYPE
+    # Every block is fixed by the hash of the block after it, so the last hash identifies the whole range.
+    etag = f'{snapshot[-1].hash if snapshot else "empty"}-{start}-{len(snapshot)}{"-bin" if binary else ""}'
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    use_gzip = 'gzip' in request.accept_encodings
+    if binary:
+        body = encode_blocks(snapshot)
+        if use_gzip:
+            body = gzip.compress(body, 6)
+    elif len(snapshot) > STREAM_THRESHOLD:
+        body = gzip_chunks(chain_chunks(snapshot)) if use_gzip else chain_chunks(snapshot)
+    else:
+        body = ''.join(chain_chunks(snapshot))
+        if use_gzip:
+            body = gzip.compress(body.encode(), 6)
+    response = Response(body, status=200, mimetype=CONTENT_TYPE if binary else 'application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.route('/chain/tip', methods=['GET'])
+def get_chain_tip():
+    tip = blockchain.get_tip()
+    return jsonify({
+        'height': tip.index,
+        'hash': tip.hash
+    }), 200
+
+@app.route('/chain/hashes', methods=['GET'])
+def get_chain_hashes():
+    start = max(request.args.get('from', 0, type=int), 0)
+    limit = request.args.get('limit', None, type=int)
+    return jsonify({
+        'from': start,
+        'hashes': [block.hash for block in blockchain.get_blocks(start, limit)]
+    }), 200
+
+@app.route('/proof/<int:height>/<tx_hash>', methods=['GET'])
+def get_tx_proof(height, tx_hash):
+    proof = blockchain.get_tx_proof(height, tx_hash)
+    if proof is None:
+        return jsonify({
+            'message': 'Transaction not found in a merkle block at that height.'
+        }), 404
+    return jsonify(proof), 200
 
 @app.route('/transactions', methods=['GET'])
 def get_open_transactions():
     txs = blockchain.open_transactions[:]
-    return jsonify([tx.__dict__ for tx in txs]), 200
+    return jsonify([tx.to_dict() for tx in txs]), 200
+
+# A single encoded transaction or block, None if the body is not in the binary encoding.
+def decode_body(decode):
+    if request.mimetype != CONTENT_TYPE:
+        return None
+    items = decode(request.get_data())
+    if len(items) != 1:
+        raise CodecError('Expected exactly one item')
+    return items[0]
 
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    values = request.get_json()
+    try:
+        tx = decode_body(decode_transactions)
+    except CodecError as e:
+        return jsonify({
+            'message': f'Malformed transaction: {e}'
+        }), 400
+    values = tx.to_dict() if tx is not None else request.get_json()
     if not values:
         return jsonify({
             'message': 'No data found.'
@@ -84,16 +213,12 @@ def broadcast_transaction():
         return jsonify({
             'message': 'Required fields are missing'
         }),400
-    success = blockchain.add_transaction(values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True)
+    scheme = values.get('scheme', RSA)
+    success = blockchain.add_transaction(values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True, scheme=scheme)
     if success:
         return jsonify({
             'message': 'Transaction broadcast.',
-            'transaction': {
-                'sender': values['sender'],
-                'recipient': values['recipient'],
-                'amount': values['amount'],
-                'signature': values['signature']
-            }
+            'transaction': Transaction(values['sender'], values['recipient'], values['signature'], values['amount'], scheme).to_dict()
         }), 201
     else:
         return jsonify({
@@ -113,16 +238,11 @@ def add_transaction():
             'message': 'Required data is missing'
         }), 400
     signature = wallet.sign_tx(wallet.public_key, values['recipient'], values['amount'])
-    success = blockchain.add_transaction(values['recipient'], wallet.public_key, signature, values['amount'])
+    success = blockchain.add_transaction(values['recipient'], wallet.public_key, signature, values['amount'], scheme=wallet.scheme)
     if success:
         return jsonify({
             'message': 'Successfully added transaction.',
-            'transaction': {
-                'sender': wallet.public_key,
-                'recipient': values['recipient'],
-                'amount': values['amount'],
-                'signature': signature
-            },
+            'transaction': Transaction(wallet.public_key, values['recipient'], signature, values['amount'], wallet.scheme).to_dict(),
             'funds': blockchain.get_balance()
         }), 201
     else:
@@ -130,6 +250,73 @@ def add_transaction():
             'message': 'Creating a transaction failed.'
         }), 500
 
+def valid_amount(amount):
+    return isinstance(amount, (int, float)) and not isinstance(amount, bool) and amount > 0
+
+# None unless item is a complete signed transaction.
+def signed_transaction(item):
+    if not isinstance(item, dict) or not all(isinstance(item.get(key), str) for key in ['sender', 'recipient', 'signature']) or item.get('scheme', RSA) not in SCHEMES:
+        return None
+    if not valid_amount(item.get('amount')):
+        return None
+    return Transaction.from_dict(item)
+
+# Add the well formed transactions in one batch, results are in request order and malformed entries are 'malformed'.
+def add_batch(entries, is_receiving):
+    txs = [tx for tx in entries if tx is not None]
+    statuses = iter(blockchain.add_transactions(txs, is_receiving=is_receiving) if txs else [])
+    results = [{
+        'status': 'malformed' if tx is None else next(statuses),
+        'transaction': None if tx is None else tx.to_dict()
+    } for tx in entries]
+    accepted = sum(1 for result in results if result['status'] == 'accepted')
+    return jsonify({
+        'message': f'{accepted} of {len(results)} transactions accepted.',
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results,
+        'funds': blockchain.get_balance()
+    }), 200
+
+# Transactions from this node's wallet, body is {"transactions": [{"recipient": ..., "amount": ...}, ...]}.
+@app.route('/transactions/batch', methods=['POST'])
+def add_transactions():
+    values = request.get_json()
+    if not values or not isinstance(values.get('transactions'), list):
+        return jsonify({
+            'message': 'A transactions list is required.'
+        }), 400
+    if len(values['transactions']) > MAX_BATCH_SIZE:
+        return jsonify({
+            'message': f'At most {MAX_BATCH_SIZE} transactions per batch.'
+        }), 413
+    valid = [isinstance(item, dict) and isinstance(item.get('recipient'), str) and valid_amount(item.get('amount')) for item in values['transactions']]
+    txs = iter(wallet.create_txs([(item['recipient'], item['amount']) for item, ok in zip(values['transactions'], valid) if ok]))
+    return add_batch([next(txs) if ok else None for ok in valid], False)
+
+# Signed transactions from a peer, JSON {"transactions": [...]} or the binary encoding.
+@app.route('/broadcast-transactions', methods=['POST'])
+def broadcast_transactions():
+    if request.mimetype == CONTENT_TYPE:
+        try:
+            entries = [tx if valid_amount(tx.amount) else None for tx in decode_transactions(request.get_data())]
+        except CodecError as e:
+            return jsonify({
+                'message': f'Malformed transactions: {e}'
+            }), 400
+    else:
+        values = request.get_json()
+        if not values or not isinstance(values.get('transactions'), list):
+            return jsonify({
+                'message': 'A transactions list is required.'
+            }), 400
+        entries = [signed_transaction(item) for item in values['transactions']]
+    if len(entries) > MAX_BATCH_SIZE:
+        return jsonify({
+            'message': f'At most {MAX_BATCH_SIZE} transactions per batch.'
+        }), 413
+    return add_batch(entries, True)
+
 @app.route('/node', methods=['POST'])
 def add_node():
     values = request.get_json()
@@ -172,13 +359,55 @@ def resolve_conflicts():
 def get_nodes():
     return jsonify({
         'message': 'Succesfully retrived nodes',
-        'all_nodes': blockchain.get_peer_nodes()
+        'all_nodes': blockchain.get_peer_nodes(),
+        'peer_stats': blockchain.broadcaster.get_stats()
     }), 200
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    CHAIN_HEIGHT.set(blockchain.get_tip().index)
+    MEMPOOL_SIZE.set(len(blockchain.mempool))
+    PEERS.set(len(blockchain.get_peer_nodes()))
+    return Response(metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+
+# The sampling profiler is off until started here, GET returns what it has collected so far.
+@app.route('/profiler', methods=['POST'])
+def start_profiler():
+    values = request.get_json(silent=True) or {}
+    interval = values.get('interval', 0.005)
+    if not isinstance(interval, (int, float)) or interval <= 0:
+        return jsonify({
+            'message': 'interval must be a positive number of seconds.'
+        }), 400
+    if not profiler.start(interval):
+        return jsonify({
+            'message': 'Profiler is already running.',
+            'profiler': profiler.to_dict()
+        }), 409
+    return jsonify({
+        'message': 'Profiler started.',
+        'profiler': profiler.to_dict()
+    }), 201
+
+@app.route('/profiler', methods=['GET'])
+def get_profile():
+    return Response(profiler.report(request.args.get('limit', None, type=int)), status=200, mimetype='text/plain')
+
+@app.route('/profiler', methods=['DELETE'])
+def stop_profiler():
+    profiler.stop()
+    return Response(profiler.report(request.args.get('limit', None, type=int)), status=200, mimetype='text/plain')
+
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
-    values = request.get_json()
+    try:
+        block = decode_body(decode_blocks)
+    except CodecError as e:
+        return jsonify({
+            'message': f'Malformed block: {e}'
+        }), 400
+    values = {'block': block} if block is not None else request.get_json()
     if not values:
         return jsonify({
             'message': 'No data found.'
@@ -187,18 +416,16 @@ def broadcast_block():
         return jsonify({
             'message': 'Required block field is missing'
         }),400
-    block = values['block']
-    if block['index'] == blockchain.chain[-1].index + 1:
-        if blockchain.add_block(block):
-            return jsonify({
-                'message': 'Block added'
-            }), 201
-        else:
-            return jsonify({
-                'message': 'Received block was rejected.'
-            }), 409
-    elif block['index'] > blockchain.chain[-1].index:
-        blockchain.resolve_conflicts = True
+    status = blockchain.receive_block(values['block'])
+    if status == 'added':
+        return jsonify({
+            'message': 'Block added'
+        }), 201
+    elif status == 'rejected':
+        return jsonify({
+            'message': 'Received block was rejected.'
+        }), 409
+    elif status == 'ahead':
         return jsonify({
             'message': 'Blockchain seems to differ from local blockchain'
         }), 200
@@ -211,7 +438,15 @@ def broadcast_block():
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Mining processes, defaults to the number of cores')
+    parser.add_argument('--verify-workers', type=int, default=None, help='Processes verifying long runs of blocks, defaults to the number of cores')
+    parser.add_argument('--mempool-size', type=int, default=10000, help='Most open transactions kept')
+    parser.add_argument('--block-size', type=int, default=1000, help='Most transactions mined into one block')
+    parser.add_argument('--full-verify', action='store_true', help='Verify the whole chain on startup instead of starting from the last snapshot')
+    parser.add_argument('--mine', action='store_true', help='Keep mining whenever there are open transactions')
+    parser.add_argument('--scheme', choices=SCHEMES, default=RSA, help='Signature scheme of a newly generated wallet')
     args = parser.parse_args()
-    wallet = Wallet(args.port)
-    blockchain = Blockchain(2, wallet.public_key, args.port)
-    app.run(host='0.0.0.0', port=args.port)
\ No newline at end of file
+    wallet = Wallet(args.port, scheme=args.scheme)
+    blockchain = Blockchain(2, wallet.public_key, args.port, mining_workers=args.workers, max_mempool_size=args.mempool_size, max_block_transactions=args.block_size, full_verify=args.full_verify, verify_workers=args.verify_workers)
+    mining_worker = MiningWorker(blockchain, wallet.public_key, continuous=args.mine).start()
+    app.run(host='0.0.0.0', port=args.port, threaded=True)
\ No newline at end of file
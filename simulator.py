@@ -0,0 +1,502 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Event, Lock, Thread
+from time import perf_counter, sleep
+import json
+import os
+import random
+import tempfile
+from block import Block
+from blockchain import Blockchain
+from transaction import Transaction
+from utility.codec import CONTENT_TYPE, decode_blocks, decode_transactions, encode_blocks
+from wallet import Wallet
+
+# Runs many Blockchain nodes in one process over an in-memory network instead of HTTP.
+# Nodes are the real Blockchain class, only the broadcaster is swapped for one that delivers to the other nodes
+# after a configurable latency, drops messages at a loss rate and refuses them across partitions.
+# All nodes share the process wide signature cache, so each signature costs CPU once rather than once per node.
+
+# Status codes node.py answers /broadcast-block with.
+BLOCK_STATUS_CODES = {'added': 201, 'rejected': 409, 'ahead': 200, 'behind': 409}
+
+class MemoryResponse:
+    def __init__(self, status_code, body=None, content=b'', content_type='application/json'):
+        self.status_code = status_code
+        self.body = body
+        self.content = content
+        self.headers = {'Content-Type': content_type}
+
+    def json(self):
+        return self.body
+
+# Runs callbacks after a delay on a thread pool, so messages in flight do not hold a thread while they wait.
+class Scheduler:
+    def __init__(self, workers=32):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = []
+        self.seq = count()
+        self.pending = 0
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, fn, *args):
+        with self.condition:
+            heappush(self.queue, (perf_counter() + delay, next(self.seq), fn, args))
+            self.pending += 1
+            self.condition.notify_all()
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                wait = self.queue[0][0] - perf_counter()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, fn, args = heappop(self.queue)
+                self.executor.submit(self.call, fn, args)
+
+    def call(self, fn, args):
+        try:
+            fn(*args)
+        finally:
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    # Wait until nothing is scheduled or running, False on timeout.
+    def wait_idle(self, timeout=30):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.pending == 0, timeout)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+
+class MemoryNetwork:
+    def __init__(self, latency=0.02, jitter=0.01, loss=0.0, timeout=0.5, seed=0, workers=32):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        # How long a lost request keeps the caller waiting, like a request timing out.
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.nodes = {}
+        # address -> group while partitioned, messages only pass within a group.
+        self.groups = None
+        self.scheduler = Scheduler(workers)
+        self.stats = {'messages': 0, 'lost': 0, 'partitioned': 0}
+        self.lock = Lock()
+        # on_block(address, block, status) after a node handled a broadcast block.
+        self.on_block = None
+
+    def add(self, address, blockchain):
+        self.nodes[address] = blockchain
+
+    def broadcaster(self, address):
+        return MemoryBroadcaster(self, address)
+
+    def partition(self, groups):
+        with self.lock:
+            self.groups = {address: idx for idx, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        with self.lock:
+            self.groups = None
+
+    def delay(self):
+        with self.lock:
+            return self.latency + self.rng.uniform(0, self.jitter)
+
+    # 'ok', 'lost' or 'partitioned' for one message from source to target.
+    def route(self, source, target):
+        with self.lock:
+            self.stats['messages'] += 1
+            if target not in self.nodes or (self.groups is not None and self.groups.get(source) != self.groups.get(target)):
+                self.stats['partitioned'] += 1
+                return 'partitioned'
+            if self.rng.random() < self.loss:
+                self.stats['lost'] += 1
+                return 'lost'
+            return 'ok'
+
+    # The peer facing endpoints of node.py, called on the target node directly.
+    def handle(self, target, method, path, payload=None, data=None, params=None):
+        blockchain = self.nodes[target]
+        params = params or {}
+        if method == 'POST' and path == '/broadcast-block':
+            block = decode_blocks(data)[0] if data is not None else Block.from_dict(payload['block'])
+            status = blockchain.receive_block(block)
+            if self.on_block is not None:
+                self.on_block(target, block, status)
+            return MemoryResponse(BLOCK_STATUS_CODES[status], {'status': status})
+        if method == 'POST' and path == '/broadcast-transaction':
+            tx = decode_transactions(data)[0] if data is not None else Transaction.from_dict(payload)
+            success = blockchain.add_transaction(tx.recipient, tx.sender, tx.signature, tx.amount, is_receiving=True, scheme=tx.scheme)
+            return MemoryResponse(201 if success else 500)
+        if method == 'POST' and path == '/broadcast-transactions':
+            txs = decode_transactions(data) if data is not None else [Transaction.from_dict(tx) for tx in payload['transactions']]
+            return MemoryResponse(200, {'results': blockchain.add_transactions(txs, is_receiving=True)})
+        if method == 'GET' and path == '/chain/tip':
+            tip = blockchain.get_tip()
+            return MemoryResponse(200, {'height': tip.index, 'hash': tip.hash})
+        if method == 'GET' and path == '/chain/hashes':
+            start = max(params.get('from', 0), 0)
+            return MemoryResponse(200, {'from': start, 'hashes': [block.hash for block in blockchain.get_blocks(start, params.get('limit'))]})
+        if method == 'GET' and path == '/chain':
+            blocks = blockchain.get_blocks(max(params.get('from', 0), 0), params.get('limit'))
+            return MemoryResponse(200, content=encode_blocks(blocks), content_type=CONTENT_TYPE)
+        return MemoryResponse(404)
+
+    def stop(self):
+        self.scheduler.stop()
+
+# Same interface as Broadcaster, for one node on a MemoryNetwork.
+class MemoryBroadcaster:
+    def __init__(self, network, address):
+        self.network = network
+        self.address = address
+        self.stats = {}
+        self.lock = Lock()
+
+    def record(self, node, latency=None):
+        with self.lock:
+            stats = self.stats.setdefault(node, {'sent': 0, 'failed': 0, 'latency': None})
+            stats['sent'] += 1
+            if latency is None:
+                stats['failed'] += 1
+            else:
+                stats['latency'] = latency
+
+    # Blocks the caller for the round trip, like a real request.
+    def request(self, method, node, path, payload=None, data=None, params=None):
+        route = self.network.route(self.address, node)
+        if route != 'ok':
+            if route == 'lost':
+                sleep(self.network.timeout)
+            self.record(node)
+            return None
+        started = perf_counter()
+        sleep(self.network.delay())
+        resp = self.network.handle(node, method, path, payload, data, params)
+        sleep(self.network.delay())
+        self.record(node, perf_counter() - started)
+        return resp
+
+    def post(self, node, path, payload, data=None):
+        return self.request('POST', node, path, payload, data)
+
+    def get(self, node, path, params=None, headers=None):
+        return self.request('GET', node, path, params=params)
+
+    def broadcast(self, nodes, path, payload, on_response=None, data=None):
+        for node in list(nodes):
+            self.network.scheduler.call_later(self.network.delay(), self.deliver, node, path, payload, on_response, data, perf_counter())
+        return []
+
+    def deliver(self, node, path, payload, on_response, data, started):
+        if self.network.route(self.address, node) != 'ok':
+            self.record(node)
+            return
+        resp = self.network.handle(node, 'POST', path, payload, data)
+        self.network.scheduler.call_later(self.network.delay(), self.respond, node, resp, on_response, started)
+
+    def respond(self, node, resp, on_response, started):
+        self.record(node, perf_counter() - started)
+        if on_response is not None:
+            on_response(node, resp)
+
+    def send(self, node, path, payload, on_response, data=None):
+        resp = self.post(node, path, payload, data)
+        if resp is not None and on_response is not None:
+            on_response(node, resp)
+        return resp
+
+    def forget(self, node):
+        with self.lock:
+            self.stats.pop(node, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {node: stats.copy() for node, stats in self.stats.items()}
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def summary(values):
+    return {
+        'count': len(values),
+        'median': percentile(values, 0.5),
+        'p90': percentile(values, 0.9),
+        'max': max(values) if values else None
+    }
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.network = MemoryNetwork(args.latency, args.jitter, args.loss, args.timeout, args.seed)
+        self.network.on_block = self.on_block
+        self.addresses = []
+        self.nodes = {}
+        self.wallets = {}
+        # block hash -> (time mined, miner address)
+        self.mined = {}
+        # address -> {block hash: time the node first had it}
+        self.seen = {}
+        self.deliveries = {'added': 0, 'rejected': 0, 'ahead': 0, 'behind': 0}
+        self.resolves = []
+        self.resolving = set()
+        self.submitted = 0
+        self.accepted = 0
+        self.lock = Lock()
+        self.stopped = Event()
+        self.started = None
+        # (start, end) in seconds of the partition, if there was one.
+        self.partitioned = None
+
+    def now(self):
+        return perf_counter() - self.started
+
+    def setup(self):
+        # Every node runs in this process, process pools would fork the whole simulation.
+        Wallet.verifier.workers = 1
+        for idx in range(self.args.nodes):
+            address = f'node-{idx}'
+            wallet = Wallet(f'sim-{idx}', random.Random(f'{self.args.seed}-{idx}').randbytes)
+            blockchain = Blockchain(self.args.difficulty, wallet.public_key, f'sim-{idx}', mining_workers=1, verify_workers=1, broadcaster=self.network.broadcaster(address))
+            self.network.add(address, blockchain)
+            self.addresses.append(address)
+            self.nodes[address] = blockchain
+            self.wallets[address] = wallet
+            self.seen[address] = {blockchain.get_tip().hash: 0.0}
+        for address, blockchain in self.nodes.items():
+            others = [other for other in self.addresses if other != address]
+            peers = others if self.args.peers is None else self.rng.sample(others, min(self.args.peers, len(others)))
+            for peer in peers:
+                blockchain.add_peer_node(peer)
+
+    def mark_seen(self, address, block_hash):
+        with self.lock:
+            self.seen[address].setdefault(block_hash, self.now())
+
+    def on_block(self, address, block, status):
+        with self.lock:
+            self.deliveries[status] += 1
+        if status == 'added':
+            self.mark_seen(address, block.hash)
+
+    def resolve(self, address):
+        blockchain = self.nodes[address]
+        started = perf_counter()
+        replaced = blockchain.resolve()
+        with self.lock:
+            self.resolves.append({'seconds': perf_counter() - started, 'replaced': replaced})
+            self.resolving.discard(address)
+        if replaced:
+            for block in blockchain.get_blocks():
+                self.mark_seen(address, block.hash)
+        return replaced
+
+    def mine(self, address):
+        blockchain = self.nodes[address]
+        if blockchain.resolve_conflicts:
+            return None
+        block = blockchain.mine_block(self.wallets[address].public_key)
+        if block:
+            with self.lock:
+                self.mined[block.hash] = (self.now(), address)
+            self.mark_seen(address, block.hash)
+        return block or None
+
+    # Each miner finds blocks at random, on average one per block_interval over all miners.
+    def miner_loop(self, address, interval):
+        rng = random.Random(f'{self.args.seed}-miner-{address}')
+        while not self.stopped.wait(rng.expovariate(1 / interval)):
+            self.mine(address)
+
+    def transaction_loop(self):
+        rng = random.Random(f'{self.args.seed}-transactions')
+        while not self.stopped.wait(rng.expovariate(self.args.tx_rate)):
+            address = rng.choice(self.addresses)
+            wallet = self.wallets[address]
+            blockchain = self.nodes[address]
+            if blockchain.get_balance() < 1:
+                continue
+            recipient = self.wallets[rng.choice([other for other in self.addresses if other != address])].public_key
+            signature = wallet.sign_tx(wallet.public_key, recipient, 1)
+            success = blockchain.add_transaction(recipient, wallet.public_key, signature, 1)
+            with self.lock:
+                self.submitted += 1
+                self.accepted += 1 if success else 0
+
+    # Nodes that were told about a longer chain resolve, like an operator hitting /resolve-conflicts.
+    def resolver_loop(self, pool):
+        while not self.stopped.wait(self.args.resolve_interval):
+            for address, blockchain in self.nodes.items():
+                with self.lock:
+                    if not blockchain.resolve_conflicts or address in self.resolving:
+                        continue
+                    self.resolving.add(address)
+                pool.submit(self.resolve, address)
+
+    def partition_loop(self):
+        if self.args.partition_at is None or self.stopped.wait(self.args.partition_at):
+            return
+        half = len(self.addresses) // 2
+        self.network.partition([self.addresses[:half], self.addresses[half:]])
+        self.partitioned = (self.now(), None)
+        self.stopped.wait(self.args.partition_for)
+        self.network.heal()
+        self.partitioned = (self.partitioned[0], self.now())
+
+    # After the load stops every node resolves until all tips agree.
+    # A tie between equally long chains is broken by mining one more block on one of them.
+    def converge(self, pool):
+        started = perf_counter()
+        rounds = 0
+        tie_breaks = 0
+        while rounds < self.args.max_rounds:
+            rounds += 1
+            self.network.scheduler.wait_idle()
+            replaced = list(pool.map(self.resolve, self.addresses))
+            self.network.scheduler.wait_idle()
+            if len({blockchain.get_tip().hash for blockchain in self.nodes.values()}) == 1:
+                return {'converged': True, 'seconds': perf_counter() - started, 'rounds': rounds, 'tie_breaks': tie_breaks}
+            if not any(replaced):
+                tip = max(self.nodes.values(), key=lambda blockchain: blockchain.get_tip().index).get_tip()
+                address = next(address for address, blockchain in self.nodes.items() if blockchain.get_tip() is tip)
+                self.nodes[address].resolve_conflicts = False
+                if self.mine(address):
+                    tie_breaks += 1
+        return {'converged': False, 'seconds': perf_counter() - started, 'rounds': rounds, 'tie_breaks': tie_breaks}
+
+    def run(self):
+        self.setup()
+        self.started = perf_counter()
+        miners = self.addresses[:self.args.miners or len(self.addresses)]
+        threads = [Thread(target=self.miner_loop, args=(address, self.args.block_interval * len(miners)), daemon=True) for address in miners]
+        threads.append(Thread(target=self.transaction_loop, daemon=True))
+        threads.append(Thread(target=self.partition_loop, daemon=True))
+        with ThreadPoolExecutor(max_workers=len(self.addresses)) as pool:
+            threads.append(Thread(target=self.resolver_loop, args=(pool,), daemon=True))
+            for thread in threads:
+                thread.start()
+            self.stopped.wait(self.args.duration)
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
+            load_seconds = self.now()
+            self.network.heal()
+            convergence = self.converge(pool)
+        self.network.stop()
+        return self.report(load_seconds, convergence)
+
+    def report(self, load_seconds, convergence):
+        final = self.nodes[self.addresses[0]].get_blocks()
+        final_hashes = {block.hash for block in final}
+        propagation = []
+        arrivals = []
+        for block_hash, (mined_at, _) in self.mined.items():
+            if block_hash not in final_hashes:
+                continue
+            times = [self.seen[address].get(block_hash) for address in self.addresses]
+            if all(seen_at is not None for seen_at in times):
+                propagation.append(max(times) - mined_at)
+            arrivals.extend(seen_at - mined_at for seen_at in times if seen_at is not None and seen_at > mined_at)
+        orphans = sum(1 for block_hash in self.mined if block_hash not in final_hashes)
+        delivered = sum(self.deliveries.values())
+        confirmed = sum(len(block.transactions) - 1 for block in final[1:])
+        return {
+            'nodes': len(self.addresses),
+            'load_seconds': load_seconds,
+            'partition': self.partitioned,
+            'blocks': {
+                'mined': len(self.mined),
+                'final_height': final[-1].index,
+                'orphaned': orphans,
+                'orphan_rate': orphans / len(self.mined) if self.mined else None
+            },
+            'propagation_seconds': summary(propagation),
+            'arrival_seconds': summary(arrivals),
+            'block_deliveries': dict(self.deliveries, conflict_rate=(delivered - self.deliveries['added']) / delivered if delivered else None),
+            'resolve': dict(summary([entry['seconds'] for entry in self.resolves]), replaced=sum(1 for entry in self.resolves if entry['replaced'])),
+            'convergence': convergence,
+            'transactions': {
+                'submitted': self.submitted,
+                'accepted': self.accepted,
+                'confirmed': confirmed,
+                'confirmed_per_sec': confirmed / load_seconds
+            },
+            'network': dict(self.network.stats)
+        }
+
+def print_report(report):
+    blocks = report['blocks']
+    print(f'{report["nodes"]} nodes for {report["load_seconds"]:.1f}s')
+    print(f'  blocks: {blocks["mined"]} mined, final height {blocks["final_height"]}, {blocks["orphaned"]} orphaned ({(blocks["orphan_rate"] or 0) * 100:.1f}%)')
+    for name in ('propagation_seconds', 'arrival_seconds', 'resolve'):
+        entry = report[name]
+        if entry['count']:
+            print(f'  {name}: median {entry["median"] * 1000:.0f} ms, p90 {entry["p90"] * 1000:.0f} ms, max {entry["max"] * 1000:.0f} ms over {entry["count"]}')
+    deliveries = report['block_deliveries']
+    print(f'  block deliveries: {deliveries["added"]} added, {deliveries["rejected"]} rejected, {deliveries["ahead"]} ahead, {deliveries["behind"]} behind, conflict rate {(deliveries["conflict_rate"] or 0) * 100:.1f}%')
+    convergence = report['convergence']
+    print(f'  convergence: {"converged" if convergence["converged"] else "NOT converged"} in {convergence["seconds"]:.2f}s, {convergence["rounds"]} rounds, {convergence["tie_breaks"]} tie breaking blocks')
+    txs = report['transactions']
+    print(f'  transactions: {txs["submitted"]} submitted, {txs["accepted"]} accepted, {txs["confirmed"]} confirmed, {txs["confirmed_per_sec"]:.1f} confirmed/s')
+    network = report['network']
+    print(f'  network: {network["messages"]} messages, {network["lost"]} lost, {network["partitioned"]} refused by partitions')
+
+def main():
+    parser = ArgumentParser(description='Simulate a network of nodes in one process.')
+    parser.add_argument('-n', '--nodes', type=int, default=8)
+    parser.add_argument('--peers', type=int, default=None, help='Random peers per node, defaults to every other node')
+    parser.add_argument('--miners', type=int, default=None, help='How many of the nodes mine, defaults to all')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load')
+    parser.add_argument('--block-interval', type=float, default=2, help='Average seconds between blocks over all miners')
+    parser.add_argument('--tx-rate', type=float, default=20, help='Transactions per second over all nodes')
+    parser.add_argument('--difficulty', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds every message takes one way')
+    parser.add_argument('--jitter', type=float, default=0.01, help='Up to this many seconds are added to the latency at random')
+    parser.add_argument('--loss', type=float, default=0.0, help='Fraction of messages dropped')
+    parser.add_argument('--timeout', type=float, default=0.5, help='Seconds a request waits for a dropped answer')
+    parser.add_argument('--partition-at', type=float, default=None, help='Split the nodes in two halves after this many seconds')
+    parser.add_argument('--partition-for', type=float, default=5, help='Seconds the partition lasts')
+    parser.add_argument('--resolve-interval', type=float, default=0.1, help='Seconds between checks for nodes that need to resolve')
+    parser.add_argument('--max-rounds', type=int, default=50, help='Most resolve rounds while converging')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default=None, help='Also write the report as JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the nodes')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Nodes keep their wallets and chains in the working directory.
+    os.chdir(tempfile.mkdtemp(prefix='blockchain-sim-'))
+    simulation = Simulation(args)
+    if args.verbose:
+        report = simulation.run()
+    else:
+        with open(os.devnull, mode='w') as devnull, redirect_stdout(devnull):
+            report = simulation.run()
+    print_report(report)
+    if output is not None:
+        with open(output, mode='w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import json
+from hashlib import sha256
+import os
+import sqlite3
+from threading import Lock
+from block import Block
+from transaction import Transaction
+from utility.codec import encode_blocks, decode_blocks, encode_transactions, decode_transactions
+from utility.metrics import metrics
+
+WRITE_SECONDS = metrics.histogram('blockchain_storage_write_seconds', 'Time spent on storage writes (commit included), by operation')
+WRITE_BYTES = metrics.counter('blockchain_storage_written_bytes_total', 'Encoded bytes written to storage, by operation')
+
+# Blocks are an append-only table keyed by height, open transactions and peers live in their own tables,
+# so adding a block or a transaction writes one row instead of the whole chain.
+# Rows hold the binary encoding from utility.codec, rows written as JSON text by older versions are still read.
+class Storage:
+    def __init__(self, node_id):
+        self.path = f'blockchain-{node_id}.db'
+        self.legacy_path = f'blockchain-{node_id}.txt'
+        self.lock = Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS blocks (height INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+            self.upgrade_open_transactions()
+            # Rows are keyed by tx hash so confirming a transaction is an index lookup, id keeps the arrival order.
+            self.conn.execute('CREATE TABLE IF NOT EXISTS open_transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT NOT NULL UNIQUE, data BLOB NOT NULL)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS peer_nodes (node TEXT PRIMARY KEY)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS snapshot (id INTEGER PRIMARY KEY CHECK (id = 1), data TEXT NOT NULL, checksum TEXT NOT NULL)')
+        self.migrate()
+
+    # Earlier versions keyed open transactions by signature without an index, move their rows to the hash keyed table.
+    def upgrade_open_transactions(self):
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(open_transactions)')]
+        if not columns or 'hash' in columns:
+            return
+        rows = [data for (data,) in self.conn.execute('SELECT data FROM open_transactions ORDER BY id')]
+        self.conn.execute('DROP TABLE open_transactions')
+        self.conn.execute('CREATE TABLE open_transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, hash TEXT NOT NULL UNIQUE, data BLOB NOT NULL)')
+        self.conn.executemany('INSERT OR IGNORE INTO open_transactions (hash, data) VALUES (?, ?)', [self.tx_row(self.decode_tx(data)) for data in rows])
+
+    def is_empty(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM blocks').fetchone()[0] == 0
+
+    # Import a blockchain-<port>.txt written by older versions, the file itself is left untouched.
+    def migrate(self):
+        if not self.is_empty() or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, mode='r') as f:
+                file_content = f.readlines()
+            chain = json.loads(file_content[0])
+            open_transactions = json.loads(file_content[1])
+            peer_nodes = json.loads(file_content[2])
+        except (IOError, IndexError, ValueError):
+            print(f'Failed to migrate {self.legacy_path}.')
+            return
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT INTO blocks (height, data) VALUES (?, ?)', [(block['index'], self.encode_block(Block.from_dict(block))) for block in chain])
+            self.conn.executemany('INSERT OR IGNORE INTO open_transactions (hash, data) VALUES (?, ?)', [self.tx_row(Transaction.from_dict(tx)) for tx in open_transactions])
+            self.conn.executemany('INSERT OR IGNORE INTO peer_nodes (node) VALUES (?)', [(node,) for node in peer_nodes])
+        print(f'Migrated {self.legacy_path} into {self.path}.')
+
+    @staticmethod
+    def encode_block(block):
+        return sqlite3.Binary(encode_blocks([block]))
+
+    @staticmethod
+    def decode_block(data):
+        if isinstance(data, bytes):
+            return decode_blocks(data)[0]
+        return Block.from_dict(json.loads(data))
+
+    @staticmethod
+    def encode_tx(tx):
+        return sqlite3.Binary(encode_transactions([tx]))
+
+    @classmethod
+    def tx_row(cls, tx):
+        return (tx.hash, cls.encode_tx(tx))
+
+    @staticmethod
+    def decode_tx(data):
+        if isinstance(data, bytes):
+            return decode_transactions(data)[0]
+        return Transaction.from_dict(json.loads(data))
+
+    # Rows are yielded one at a time so the chain is never held as a single string.
+    def load_blocks(self):
+        with self.lock:
+            for (data,) in self.conn.execute('SELECT data FROM blocks ORDER BY height'):
+                yield self.decode_block(data)
+
+    def load_open_transactions(self):
+        with self.lock:
+            return [self.decode_tx(data) for (data,) in self.conn.execute('SELECT data FROM open_transactions ORDER BY id')]
+
+    def load_peer_nodes(self):
+        with self.lock:
+            return [node for (node,) in self.conn.execute('SELECT node FROM peer_nodes')]
+
+    # Confirmed transactions leave the mempool in the same commit that stores their block.
+    def append_block(self, block, confirmed_transactions=()):
+        data = self.encode_block(block)
+        WRITE_BYTES.inc(len(data), op='append_block')
+        with self.lock, WRITE_SECONDS.time(op='append_block'), self.conn:
+            self.conn.execute('INSERT INTO blocks (height, data) VALUES (?, ?)', (block.index, data))
+            self.conn.executemany('DELETE FROM open_transactions WHERE hash = ?', [(tx.hash,) for tx in confirmed_transactions])
+
+    # Drop every block from blocks[0].index up and store blocks in their place.
+    def replace_blocks(self, blocks):
+        rows = [(block.index, self.encode_block(block)) for block in blocks]
+        WRITE_BYTES.inc(sum(len(data) for _, data in rows), op='replace_blocks')
+        with self.lock, WRITE_SECONDS.time(op='replace_blocks'), self.conn:
+            self.conn.execute('DELETE FROM blocks WHERE height >= ?', (blocks[0].index,))
+            self.conn.executemany('INSERT INTO blocks (height, data) VALUES (?, ?)', rows)
+
+    def add_transaction(self, tx):
+        row = self.tx_row(tx)
+        WRITE_BYTES.inc(len(row[1]), op='add_transaction')
+        with self.lock, WRITE_SECONDS.time(op='add_transaction'), self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO open_transactions (hash, data) VALUES (?, ?)', row)
+
+    # One commit for the whole batch.
+    def add_transactions(self, txs):
+        rows = [self.tx_row(tx) for tx in txs]
+        WRITE_BYTES.inc(sum(len(data) for _, data in rows), op='add_transactions')
+        with self.lock, WRITE_SECONDS.time(op='add_transactions'), self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO open_transactions (hash, data) VALUES (?, ?)', rows)
+
+    def clear_transactions(self):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM open_transactions')
+
+    def add_peer_node(self, node):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO peer_nodes (node) VALUES (?)', (node,))
+
+    def remove_peer_node(self, node):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM peer_nodes WHERE node = ?', (node,))
+
+    # The verified state at a height, so startup only has to verify the blocks after it.
+    def save_snapshot(self, height, tip_hash, balances):
+        data = json.dumps({'height': height, 'tip_hash': tip_hash, 'balances': balances})
+        WRITE_BYTES.inc(len(data), op='save_snapshot')
+        with self.lock, WRITE_SECONDS.time(op='save_snapshot'), self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO snapshot (id, data, checksum) VALUES (1, ?, ?)', (data, sha256(data.encode()).hexdigest()))
+
+    # None if there is no snapshot or it is damaged.
+    def load_snapshot(self):
+        with self.lock:
+            row = self.conn.execute('SELECT data, checksum FROM snapshot WHERE id = 1').fetchone()
+        if row is None:
+            return None
+        data, checksum = row
+        if sha256(data.encode()).hexdigest() != checksum:
+            print('Snapshot is damaged, ignoring it.')
+            return None
+        try:
+            snapshot = json.loads(data)
+            return {'height': int(snapshot['height']), 'tip_hash': snapshot['tip_hash'], 'balances': dict(snapshot['balances'])}
+        except (ValueError, KeyError, TypeError):
+            print('Snapshot is damaged, ignoring it.')
+            return None
+
+    # Full rewrite, only needed when there is no log to append to yet.
+    def save_all(self, chain, open_transactions, peer_nodes):
+        block_rows = [(block.index, self.encode_block(block)) for block in chain]
+        tx_rows = [self.tx_row(tx) for tx in open_transactions]
+        WRITE_BYTES.inc(sum(len(data) for _, data in block_rows + tx_rows), op='save_all')
+        with self.lock, WRITE_SECONDS.time(op='save_all'), self.conn:
+            self.conn.execute('DELETE FROM blocks')
+            self.conn.execute('DELETE FROM open_transactions')
+            self.conn.execute('DELETE FROM peer_nodes')
+            self.conn.executemany('INSERT INTO blocks (height, data) VALUES (?, ?)', block_rows)
+            self.conn.executemany('INSERT OR IGNORE INTO open_transactions (hash, data) VALUES (?, ?)', tx_rows)
+            self.conn.executemany('INSERT INTO peer_nodes (node) VALUES (?)', [(node,) for node in peer_nodes])
@@ -0,0 +1,16 @@
+import json
+from block import MERKLE_VERSION, Block, block_json
+from transaction import Transaction
+
+def make_block(index, version):
+    return Block(index, 'previous', [Transaction('MINING', 'recipient', '', 10)], 100, 0, version)
+
+# A full chain scan builds the blocks without evicting the recently served ones.
+def test_uncached_json_leaves_the_cache_alone():
+    block_json.cache_clear()
+    for version in (1, MERKLE_VERSION):
+        block = make_block(0, version)
+        assert json.loads(block.to_json(cached=False)) == block.to_dict()
+    assert block_json.cache_info().currsize == 0
+    block.to_json()
+    assert block_json.cache_info().currsize == 1
@@ -0,0 +1,50 @@
+from itertools import count
+import random
+import sqlite3
+import pytest
+from block import MERKLE_VERSION, Block
+from blockchain import Blockchain
+from transaction import Transaction
+from utility.hash_utils import hash_block
+from utility.verification import Verification
+from wallet import Wallet
+
+@pytest.fixture
+def blockchain(tmp_path, monkeypatch):
+    # Wallets and the database are written to the working directory.
+    monkeypatch.chdir(tmp_path)
+    wallet = Wallet('test', random.Random(0).randbytes)
+    return Blockchain(1, wallet.public_key, 'test', mining_workers=1)
+
+# A failed write must not leave a block in memory that the database skips.
+def test_failed_append_leaves_no_gap(blockchain, monkeypatch):
+    append_block = blockchain.storage.append_block
+    def fail(block, confirmed_transactions=()):
+        monkeypatch.setattr(blockchain.storage, 'append_block', append_block)
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(blockchain.storage, 'append_block', fail)
+    assert not blockchain.mine_block(blockchain.public_key)
+    assert len(blockchain.chain) == 1
+    block = blockchain.mine_block(blockchain.public_key)
+    assert block and block.index == 1
+    assert [stored.index for stored in blockchain.storage.load_blocks()] == [0, 1]
+    assert blockchain.get_balance(blockchain.public_key) == blockchain.reward
+
+def make_block(blockchain, transactions):
+    tip = blockchain.chain[-1]
+    timestamp = tip.timestamp + 1
+    for proof in count():
+        block = Block(tip.index + 1, hash_block(tip), transactions + [Transaction('MINING', 'miner', '', blockchain.reward)], proof, timestamp, MERKLE_VERSION)
+        if Verification.valid_block_proof(block, blockchain.difficulty):
+            return block
+
+# add_block has to check balances, the ledger it fills is saved as a verified snapshot.
+def test_add_block_rejects_unfunded_transactions(blockchain):
+    wallet = Wallet('test')
+    assert blockchain.mine_block(wallet.public_key)
+    unfunded = wallet.create_txs([('recipient', 5), ('recipient', 1000)])
+    assert not blockchain.add_block(make_block(blockchain, unfunded))
+    assert blockchain.get_balance('recipient') == 0
+    assert blockchain.add_block(make_block(blockchain, unfunded[:1]))
+    assert blockchain.get_balance('recipient') == 5
+    assert [stored.index for stored in blockchain.storage.load_blocks()] == [0, 1, 2]
@@ -0,0 +1,13 @@
+import pytest
+from transaction import Transaction
+from utility.codec import CodecError, decode_transactions, encode_transactions
+
+def test_invalid_utf8_is_a_codec_error():
+    data = encode_transactions([Transaction('MINING', 'récipient', '', 1)])
+    assert decode_transactions(data)[0].recipient == 'récipient'
+    with pytest.raises(CodecError):
+        decode_transactions(data.replace('é'.encode('utf8'), b'\xff\xfe'))
+
+def test_unencodable_string_is_a_codec_error():
+    with pytest.raises(CodecError):
+        encode_transactions([Transaction('MINING', '\ud800', '', 1)])
@@ -0,0 +1,30 @@
+import gc
+import pickle
+from transaction import Transaction
+from utility.key_index import KeyIndex, keys
+
+def test_equal_keys_are_shared():
+    first = Transaction('a' * 324, 'b' * 324, '', 1)
+    second = Transaction('a' * 324, 'c' * 324, '', 1)
+    assert first.sender is second.sender
+    assert first.sender == 'a' * 324
+
+# Keys from transactions that were thrown away (e.g. failed verification) must not pile up.
+def test_keys_are_dropped_with_their_transactions():
+    before = len(keys)
+    txs = [Transaction(f'junk-sender-{idx}', f'junk-recipient-{idx}', '', 1) for idx in range(100)]
+    assert len(keys) == before + 200
+    del txs
+    gc.collect()
+    assert len(keys) == before
+
+def test_non_string_keys_are_kept_as_given():
+    index = KeyIndex()
+    assert index.intern(123) == 123
+    assert len(index) == 0
+
+def test_pickled_transaction_keeps_its_hash():
+    tx = Transaction('sender', 'recipient', 'ab' * 8, 5)
+    copy = pickle.loads(pickle.dumps(tx))
+    assert copy.hash == tx.hash
+    assert copy.sender is tx.sender
@@ -0,0 +1,21 @@
+from mempool import Mempool
+from transaction import Transaction
+
+def test_self_transfer_can_be_added_and_removed():
+    mempool = Mempool()
+    tx = Transaction('key', 'key', 'ab', 5)
+    assert mempool.add(tx)
+    assert mempool.get_balance('key') == 0
+    assert mempool.remove_many([tx.hash]) == [tx]
+    assert len(mempool) == 0
+    assert mempool.pending == {}
+
+def test_pending_balances_follow_adds_and_removes():
+    mempool = Mempool()
+    first, second = Transaction('a', 'b', 'ab', 5), Transaction('b', 'a', 'cd', 2)
+    assert mempool.add(first) and mempool.add(second)
+    assert (mempool.get_balance('a'), mempool.get_balance('b')) == (-3, 3)
+    mempool.remove(first.hash)
+    assert (mempool.get_balance('a'), mempool.get_balance('b')) == (2, -2)
+    mempool.remove(second.hash)
+    assert mempool.pending == {}
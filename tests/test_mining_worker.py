@@ -0,0 +1,26 @@
+from mining_worker import MiningWorker
+
+class FailingBlockchain:
+    resolve_conflicts = False
+
+    def __init__(self):
+        self.calls = 0
+
+    def mine_block(self, public_key):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError('disk full')
+        return 'block'
+
+def test_failed_job_does_not_stop_the_worker():
+    blockchain = FailingBlockchain()
+    worker = MiningWorker(blockchain, 'key', poll_interval=0.01).start()
+    try:
+        first, second = worker.submit(), worker.submit()
+        assert first.done.wait(5) and second.done.wait(5)
+        assert first.status == 'failed'
+        assert first.message == 'Mining failed: disk full'
+        assert second.status == 'done'
+        assert worker.thread.is_alive()
+    finally:
+        worker.stopped.set()
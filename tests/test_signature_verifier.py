@@ -0,0 +1,61 @@
+import random
+import pytest
+from transaction import Transaction
+from transaction import ED25519
+from utility import signature_verifier
+from utility.signature_verifier import SignatureVerifier, check_sign
+from wallet import Wallet
+
+@pytest.fixture
+def wallet(tmp_path, monkeypatch):
+    # Wallets are written to the working directory.
+    monkeypatch.chdir(tmp_path)
+    return Wallet('test', random.Random(0).randbytes)
+
+# A valid (sender, recipient, 1, signature) whose signature starts with a digit.
+def digit_signed_tx(wallet):
+    for recipient in (f'recipient-{idx}' for idx in range(1000)):
+        signature = wallet.sign_tx(wallet.public_key, recipient, 1)
+        if signature[0].isdigit():
+            return Transaction(wallet.public_key, recipient, signature, 1)
+    raise AssertionError('No signature starting with a digit')
+
+def test_valid_signature_is_cached(wallet):
+    verifier = SignatureVerifier(workers=1)
+    tx = digit_signed_tx(wallet)
+    assert verifier.verify(tx)
+    assert verifier.verify(tx)
+    assert verifier.verify_many([tx]) == [True]
+
+# Moving the leading digit of the signature into the amount used to give the same cache key.
+def test_shifted_fields_do_not_hit_the_cache(wallet):
+    verifier = SignatureVerifier(workers=1)
+    tx = digit_signed_tx(wallet)
+    forged = Transaction(tx.sender, tx.recipient, tx.signature[1:], int('1' + tx.signature[0]))
+    assert not check_sign(forged.sender, forged.recipient, forged.amount, forged.signature)
+    assert verifier.verify(tx)
+    assert not verifier.verify(forged)
+    assert verifier.verify_many([tx, forged]) == [True, False]
+
+def test_scheme_is_part_of_the_key(wallet):
+    verifier = SignatureVerifier(workers=1)
+    tx = digit_signed_tx(wallet)
+    assert verifier.verify(tx)
+    assert not verifier.verify(Transaction(tx.sender, tx.recipient, tx.signature, tx.amount, 'ed25519'))
+
+# Signatures made by one Ed25519 backend verify under the other.
+@pytest.mark.parametrize('native', [True, False])
+def test_ed25519_backends_agree(tmp_path, monkeypatch, native):
+    monkeypatch.chdir(tmp_path)
+    if native and not signature_verifier.NATIVE_ED25519:
+        pytest.skip('cryptography is not installed')
+    signer = Wallet('signer', random.Random(0).randbytes, ED25519)
+    signature = signer.sign_tx(signer.public_key, 'recipient', 5)
+    monkeypatch.setattr(signature_verifier, 'NATIVE_ED25519', native)
+    signature_verifier.import_ed25519_key.cache_clear()
+    try:
+        assert check_sign(signer.public_key, 'recipient', 5, signature, ED25519)
+        assert not check_sign(signer.public_key, 'recipient', 6, signature, ED25519)
+        assert Wallet('signer').sign_tx(signer.public_key, 'recipient', 5) == signature
+    finally:
+        signature_verifier.import_ed25519_key.cache_clear()
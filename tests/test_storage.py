@@ -0,0 +1,35 @@
+import sqlite3
+import pytest
+from block import Block
+from storage import Storage
+from transaction import Transaction
+
+@pytest.fixture
+def node_dir(tmp_path, monkeypatch):
+    # The database is written to the working directory.
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def make_txs(count):
+    return [Transaction(f'sender-{idx}', f'recipient-{idx}', f'signature-{idx}', idx + 1) for idx in range(count)]
+
+def test_append_block_removes_confirmed_transactions(node_dir):
+    storage = Storage(1)
+    txs = make_txs(10000)
+    storage.add_transactions(txs)
+    # Each delete is an index lookup, a table scan per confirmed transaction took seconds on a full mempool.
+    plan = storage.conn.execute('EXPLAIN QUERY PLAN DELETE FROM open_transactions WHERE hash = ?', ('',)).fetchall()
+    assert any('USING INDEX' in row[-1] for row in plan)
+    storage.append_block(Block(0, '', txs[:1000], 100, 0), txs[:1000])
+    assert [tx.hash for tx in storage.load_open_transactions()] == [tx.hash for tx in txs[1000:]]
+
+def test_signature_keyed_rows_are_upgraded(node_dir):
+    txs = make_txs(3)
+    with sqlite3.connect('blockchain-1.db') as conn:
+        conn.execute('CREATE TABLE open_transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, signature TEXT NOT NULL, data TEXT NOT NULL)')
+        conn.executemany('INSERT INTO open_transactions (signature, data) VALUES (?, ?)', [(tx.signature, Storage.encode_tx(tx)) for tx in txs + txs[:1]])
+    conn.close()
+    storage = Storage(1)
+    assert [tx.hash for tx in storage.load_open_transactions()] == [tx.hash for tx in txs]
+    storage.append_block(Block(0, '', txs[:1], 100, 0), txs[:1])
+    assert [tx.hash for tx in storage.load_open_transactions()] == [tx.hash for tx in txs[1:]]
@@ -1,18 +1,96 @@
 from collections import OrderedDict
+from hashlib import sha256
+import binascii
+import json
+from utility.key_index import keys
 
+# Signature schemes a transaction can be signed with, RSA is what every older transaction uses.
+RSA = 'rsa'
+ED25519 = 'ed25519'
+SCHEMES = (RSA, ED25519)
+
+# Transactions are immutable once built, a changed field would silently invalidate the hash of its block.
+# Kept compact since a loaded chain holds every one of them: slots instead of a __dict__, sender and recipient
+# shared through the key index and the signature as raw bytes. The public attributes are still the hex strings.
+# RSA transactions serialize exactly as before the scheme tag existed, so their hashes and old chains are unchanged.
 class Transaction:
-    def __init__(self, sender, recipient, signature, amount):
-        self.sender = sender
-        self.recipient = recipient
-        self.amount = amount
-        self.signature = signature
+    __slots__ = ('_sender', '_recipient', 'amount', 'scheme', '_signature', '_hash')
+
+    def __init__(self, sender, recipient, signature, amount, scheme=RSA):
+        set_field = object.__setattr__
+        set_field(self, '_sender', keys.intern(sender))
+        set_field(self, '_recipient', keys.intern(recipient))
+        set_field(self, 'amount', amount)
+        set_field(self, 'scheme', scheme)
+        set_field(self, '_signature', self.pack_signature(signature))
+        set_field(self, '_hash', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'Transaction is immutable, cannot set {name}')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'Transaction is immutable, cannot delete {name}')
+
+    # Lowercase hex is kept as bytes, anything else (a malformed signature from a peer) is kept as given.
+    @staticmethod
+    def pack_signature(signature):
+        if isinstance(signature, str) and len(signature) % 2 == 0 and signature == signature.lower():
+            try:
+                return binascii.unhexlify(signature)
+            except (binascii.Error, ValueError):
+                pass
+        return signature
+
+    @property
+    def sender(self):
+        return self._sender
+
+    @property
+    def recipient(self):
+        return self._recipient
+
+    @property
+    def signature(self):
+        if isinstance(self._signature, bytes):
+            return binascii.hexlify(self._signature).decode('ascii')
+        return self._signature
 
     def to_ordered_dict(self):
-        return OrderedDict([
+        ordered = OrderedDict([
                     ('sender', self.sender),
                     ('recipient', self.recipient),
                     ('amount', self.amount)
                 ])
+        if self.scheme != RSA:
+            ordered['scheme'] = self.scheme
+        return ordered
+
+    def to_dict(self):
+        converted_tx = {
+            'sender': self.sender,
+            'recipient': self.recipient,
+            'amount': self.amount,
+            'signature': self.signature
+        }
+        if self.scheme != RSA:
+            converted_tx['scheme'] = self.scheme
+        return converted_tx
+
+    # The transaction id and merkle leaf, unlike to_ordered_dict it covers the signature too.
+    # Only the 32 byte digest is kept.
+    @property
+    def hash(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash', sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).digest())
+        return self._hash.hex()
+
+    @classmethod
+    def from_dict(cls, tx):
+        return cls(tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('scheme', RSA))
+
+    # Copies (e.g. to a worker process) carry the keys themselves and are interned again on arrival.
+    def __reduce__(self):
+        return (Transaction, (self.sender, self.recipient, self.signature, self.amount, self.scheme))
 
     def __repr__(self):
-        return str(self.__dict__)
\ No newline at end of file
+        return str(self.to_dict())
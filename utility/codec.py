@@ -0,0 +1,213 @@
+import binascii
+import struct
+from block import Block
+from transaction import RSA, SCHEMES, Transaction
+
+# Compact binary encoding of blocks and transactions for storage and peers, JSON stays for the UI.
+#
+# message      := MAGIC codec_version:u8 kind:u8 key_table payload
+# key_table    := count:u32 string*      every sender/recipient is written once and referenced by position
+# blocks       := count:u32 block*
+# block        := version:u8 index:u64 previous_hash:string proof:number timestamp:number tx_count:u32 tx*
+# transactions := count:u32 tx*
+# tx           := sender:u32 recipient:u32 amount:number signature:string scheme:u8
+#                 scheme is the position in transaction.SCHEMES, version 1 messages have no scheme and are all RSA
+# string       := tag:u8 length:u32 bytes     tag 1 is lowercase hex stored as raw bytes, tag 0 is UTF-8
+# number       := tag:u8 (i64 | f64)          ints and floats are kept apart since both hash differently
+MAGIC = b'PBC'
+CODEC_VERSION = 2
+# Versions decode still reads.
+READABLE_VERSIONS = (1, 2)
+CONTENT_TYPE = 'application/x-blockchain'
+BLOCKS = 1
+TRANSACTIONS = 2
+
+class CodecError(ValueError):
+    pass
+
+class Writer:
+    def __init__(self):
+        self.parts = []
+
+    def u8(self, value):
+        self.parts.append(struct.pack('>B', value))
+
+    def u32(self, value):
+        self.parts.append(struct.pack('>I', value))
+
+    def u64(self, value):
+        self.parts.append(struct.pack('>Q', value))
+
+    def number(self, value):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise CodecError(f'Cannot encode number {value!r}')
+        if isinstance(value, int):
+            if not -2 ** 63 <= value < 2 ** 63:
+                raise CodecError(f'Number {value} does not fit in 64 bits')
+            self.parts.append(struct.pack('>Bq', 0, value))
+        else:
+            self.parts.append(struct.pack('>Bd', 1, value))
+
+    def string(self, value):
+        raw = None
+        if len(value) % 2 == 0 and value == value.lower():
+            try:
+                raw = binascii.unhexlify(value)
+            except (binascii.Error, ValueError):
+                raw = None
+        if raw is not None:
+            self.parts.append(struct.pack('>BI', 1, len(raw)))
+            self.parts.append(raw)
+        else:
+            try:
+                data = value.encode('utf8')
+            except UnicodeEncodeError:
+                raise CodecError(f'Cannot encode string {value!r}')
+            self.parts.append(struct.pack('>BI', 0, len(data)))
+            self.parts.append(data)
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.version = CODEC_VERSION
+
+    def unpack(self, fmt):
+        size = struct.calcsize(fmt)
+        if self.offset + size > len(self.data):
+            raise CodecError('Truncated data')
+        values = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += size
+        return values
+
+    def u8(self):
+        return self.unpack('>B')[0]
+
+    def u32(self):
+        return self.unpack('>I')[0]
+
+    def u64(self):
+        return self.unpack('>Q')[0]
+
+    def number(self):
+        tag = self.u8()
+        if tag == 0:
+            return self.unpack('>q')[0]
+        if tag == 1:
+            return self.unpack('>d')[0]
+        raise CodecError(f'Unknown number tag {tag}')
+
+    def string(self):
+        tag, length = self.unpack('>BI')
+        if self.offset + length > len(self.data):
+            raise CodecError('Truncated data')
+        raw = bytes(self.data[self.offset:self.offset + length])
+        self.offset += length
+        if tag == 1:
+            return binascii.hexlify(raw).decode('ascii')
+        if tag == 0:
+            try:
+                return raw.decode('utf8')
+            except UnicodeDecodeError:
+                raise CodecError('Invalid UTF-8 string')
+        raise CodecError(f'Unknown string tag {tag}')
+
+class KeyTable:
+    def __init__(self):
+        self.keys = []
+        self.ids = {}
+
+    def id(self, key):
+        if key not in self.ids:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return self.ids[key]
+
+def write_tx(writer, keys, tx):
+    writer.u32(keys.id(tx.sender))
+    writer.u32(keys.id(tx.recipient))
+    writer.number(tx.amount)
+    writer.string(tx.signature)
+    if tx.scheme not in SCHEMES:
+        raise CodecError(f'Cannot encode scheme {tx.scheme!r}')
+    writer.u8(SCHEMES.index(tx.scheme))
+
+def read_tx(reader, keys):
+    try:
+        sender, recipient = keys[reader.u32()], keys[reader.u32()]
+    except IndexError:
+        raise CodecError('Unknown key id')
+    amount = reader.number()
+    signature = reader.string()
+    scheme = RSA
+    if reader.version >= 2:
+        scheme_id = reader.u8()
+        if scheme_id >= len(SCHEMES):
+            raise CodecError(f'Unknown scheme id {scheme_id}')
+        scheme = SCHEMES[scheme_id]
+    return Transaction(sender, recipient, signature, amount, scheme)
+
+def encode(kind, items, write_item):
+    keys = KeyTable()
+    body = Writer()
+    body.u32(len(items))
+    for item in items:
+        write_item(body, keys, item)
+    header = Writer()
+    header.parts.append(MAGIC)
+    header.u8(CODEC_VERSION)
+    header.u8(kind)
+    header.u32(len(keys.keys))
+    for key in keys.keys:
+        header.string(key)
+    return header.getvalue() + body.getvalue()
+
+def decode(data, kind, read_item):
+    reader = Reader(data)
+    if bytes(reader.data[:len(MAGIC)]) != MAGIC:
+        raise CodecError('Not an encoded message')
+    reader.offset = len(MAGIC)
+    reader.version = reader.u8()
+    if reader.version not in READABLE_VERSIONS:
+        raise CodecError('Unsupported codec version')
+    if reader.u8() != kind:
+        raise CodecError('Unexpected message kind')
+    keys = [reader.string() for _ in range(reader.u32())]
+    items = [read_item(reader, keys) for _ in range(reader.u32())]
+    if reader.offset != len(reader.data):
+        raise CodecError('Trailing data')
+    return items
+
+def write_block(writer, keys, block):
+    writer.u8(block.version)
+    writer.u64(block.index)
+    writer.string(block.previous_hash)
+    writer.number(block.proof)
+    writer.number(block.timestamp)
+    writer.u32(len(block.transactions))
+    for tx in block.transactions:
+        write_tx(writer, keys, tx)
+
+def read_block(reader, keys):
+    version = reader.u8()
+    index = reader.u64()
+    previous_hash = reader.string()
+    proof = reader.number()
+    timestamp = reader.number()
+    transactions = [read_tx(reader, keys) for _ in range(reader.u32())]
+    return Block(index, previous_hash, transactions, proof, timestamp, version)
+
+def encode_blocks(blocks):
+    return encode(BLOCKS, blocks, write_block)
+
+def decode_blocks(data):
+    return decode(data, BLOCKS, read_block)
+
+def encode_transactions(txs):
+    return encode(TRANSACTIONS, txs, write_tx)
+
+def decode_transactions(data):
+    return decode(data, TRANSACTIONS, read_tx)
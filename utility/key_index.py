@@ -0,0 +1,33 @@
+from threading import Lock
+from weakref import WeakValueDictionary
+
+# A public key string that the index can refer to weakly.
+class Key(str):
+    __slots__ = ('__weakref__',)
+
+# Public keys are ~324 hex characters and the same few show up in most transactions.
+# Every distinct key is kept once here and transactions hold a reference to that copy.
+# Entries are weak, a key is dropped as soon as no transaction holds it any more, so keys from
+# transactions that failed verification (or were otherwise discarded) do not stay in memory.
+class KeyIndex:
+    def __init__(self):
+        self.keys = WeakValueDictionary()
+        self.lock = Lock()
+
+    # Anything but a string (a malformed key from a peer) is returned as given.
+    def intern(self, key):
+        if not isinstance(key, str):
+            return key
+        interned = self.keys.get(key)
+        if interned is None:
+            with self.lock:
+                interned = self.keys.get(key)
+                if interned is None:
+                    interned = Key(key)
+                    self.keys[key] = interned
+        return interned
+
+    def __len__(self):
+        return len(self.keys)
+
+keys = KeyIndex()
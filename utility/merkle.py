@@ -0,0 +1,33 @@
+from utility.hash_utils import hash_string_256
+
+def hash_pair(left, right):
+    return hash_string_256((left + right).encode())
+
+# Each level pairs up hashes, an odd one out is paired with itself.
+def merkle_levels(leaves):
+    levels = [list(leaves) or [hash_string_256(b'')]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        if len(level) % 2 == 1:
+            level = level + [level[-1]]
+        levels.append([hash_pair(level[i], level[i + 1]) for i in range(0, len(level), 2)])
+    return levels
+
+def merkle_root(leaves):
+    return merkle_levels(leaves)[-1][0]
+
+# The sibling hashes from leaf to root, each tagged with the side it goes on.
+def merkle_proof(leaves, index):
+    proof = []
+    for level in merkle_levels(leaves)[:-1]:
+        sibling = index + 1 if index % 2 == 0 else index - 1
+        sibling_hash = level[sibling] if sibling < len(level) else level[index]
+        proof.append([sibling_hash, 'right' if index % 2 == 0 else 'left'])
+        index //= 2
+    return proof
+
+def verify_merkle_proof(leaf, proof, root):
+    current = leaf
+    for sibling_hash, side in proof:
+        current = hash_pair(current, sibling_hash) if side == 'right' else hash_pair(sibling_hash, current)
+    return current == root
@@ -0,0 +1,193 @@
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from threading import Event, Lock, Thread, get_ident
+from time import perf_counter, time
+import sys
+
+# Process wide metrics rendered in the Prometheus text format, no client library needed.
+# Every metric is keyed by its label values, e.g. REQUESTS.inc(endpoint='/chain', status=200).
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = Lock()
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{format_labels(key)} {format_value(value)}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'counts': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][idx] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            entries = [(key, list(entry['counts']), entry['sum'], entry['count']) for key, entry in self.values.items()]
+        for key, counts, total, count in entries:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{format_labels(key, [("le", format_value(bound))])} {bucket_count}')
+            lines.append(f'{self.name}_bucket{format_labels(key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = Lock()
+
+    # Asking for a name twice returns the same metric, so modules can declare what they use.
+    def register(self, cls, name, description, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, description, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, description):
+        return self.register(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self.register(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram, name, description, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+metrics = Registry()
+
+# Samples the stack of every other thread at a fixed interval, turned on and off at runtime.
+# The report is in the collapsed stack format (frame;frame;frame count) that flame graph tools read.
+class SamplingProfiler:
+    def __init__(self):
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.interval = None
+        self.started = None
+        self.stopped = Event()
+        self.thread = None
+        self.lock = Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # False if it is running already.
+    def start(self, interval=0.005):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks.clear()
+            self.samples = 0
+            self.interval = interval
+            self.started = time()
+            self.stopped.clear()
+            self.thread = Thread(target=self.run, name='sampling-profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        own = get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+            with self.lock:
+                self.samples += 1
+
+    def report(self, limit=None):
+        with self.lock:
+            stacks = self.stacks.most_common(limit)
+        return '\n'.join(f'{stack} {count}' for stack, count in stacks) + '\n'
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'running': self.running,
+                'interval': self.interval,
+                'started': self.started,
+                'samples': self.samples,
+                'stacks': len(self.stacks)
+            }
+
+profiler = SamplingProfiler()
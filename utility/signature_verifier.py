@@ -0,0 +1,147 @@
+from Cryptodome.PublicKey import ECC, RSA
+from Cryptodome.Hash import SHA256
+from Cryptodome.Signature import PKCS1_v1_5, eddsa
+from collections import OrderedDict
+from functools import lru_cache
+from multiprocessing import Pool, cpu_count
+from threading import Lock
+import binascii
+from transaction import RSA as RSA_SCHEME, ED25519
+from utility.metrics import metrics
+
+# pycryptodome's eddsa is pure Python and verifies several times slower than RSA,
+# Ed25519 goes through the native cryptography package whenever it is installed.
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+    from cryptography.hazmat.primitives.serialization import load_der_private_key
+    NATIVE_ED25519 = True
+except ImportError:
+    NATIVE_ED25519 = False
+
+KEY_CACHE_SIZE = 1024
+RESULT_CACHE_SIZE = 100000
+# Below this many transactions the pool start up costs more than it saves.
+BATCH_POOL_THRESHOLD = 64
+
+SIGNATURES = metrics.counter('blockchain_signatures_total', 'Signature lookups, by result (cached, valid, invalid)')
+SIGNATURE_SECONDS = metrics.histogram('blockchain_signature_check_seconds', 'Time spent checking uncached signatures, by mode (single, batch)')
+
+# The same few senders sign most transactions, so keep their parsed keys around.
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def import_key(sender):
+    return PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(sender)))
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def import_ed25519_key(sender):
+    if NATIVE_ED25519:
+        return Ed25519PublicKey.from_public_bytes(binascii.unhexlify(sender))
+    return eddsa.new(eddsa.import_public_key(binascii.unhexlify(sender)), 'rfc8032')
+
+# Both backends sign with sign(message) and read the DER private key of a wallet file.
+def import_ed25519_signer(private_key):
+    if NATIVE_ED25519:
+        return load_der_private_key(private_key, None)
+    return eddsa.new(ECC.import_key(private_key), 'rfc8032')
+
+def signed_message(sender, recipient, amount):
+    return (str(sender) + str(recipient) + str(amount)).encode('utf8')
+
+def check_rsa(sender, recipient, amount, signature):
+    return import_key(sender).verify(SHA256.new(signed_message(sender, recipient, amount)), binascii.unhexlify(signature))
+
+# Both backends raise on a bad signature instead of returning False, eddsa a ValueError.
+def check_ed25519(sender, recipient, amount, signature):
+    key = import_ed25519_key(sender)
+    message = signed_message(sender, recipient, amount)
+    if NATIVE_ED25519:
+        try:
+            key.verify(binascii.unhexlify(signature), message)
+        except InvalidSignature:
+            return False
+        return True
+    key.verify(message, binascii.unhexlify(signature))
+    return True
+
+# Scheme tag -> check, a transaction with any other tag is invalid.
+CHECKS = {
+    RSA_SCHEME: check_rsa,
+    ED25519: check_ed25519
+}
+
+def check_sign(sender, recipient, amount, signature, scheme=RSA_SCHEME):
+    check = CHECKS.get(scheme)
+    if check is None:
+        return False
+    try:
+        return check(sender, recipient, amount, signature)
+    except (ValueError, TypeError, IndexError):
+        return False
+
+def check_signs(items):
+    return [check_sign(*item) for item in items]
+
+class SignatureVerifier:
+    def __init__(self, cache_size=RESULT_CACHE_SIZE, workers=None):
+        self.cache_size = cache_size
+        self.workers = workers or cpu_count()
+        # tx hash -> valid, oldest entries are evicted first.
+        self.results = OrderedDict()
+        self.lock = Lock()
+
+    # The cache key must tell every field apart, tx.hash is over the sorted JSON of all of them (scheme included).
+    @staticmethod
+    def tx_hash(tx):
+        return tx.hash
+
+    def cached(self, key):
+        with self.lock:
+            valid = self.results.get(key)
+            if valid is not None:
+                self.results.move_to_end(key)
+            return valid
+
+    def store(self, key, valid):
+        with self.lock:
+            self.results[key] = valid
+            self.results.move_to_end(key)
+            while len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+
+    def verify(self, tx):
+        key = self.tx_hash(tx)
+        valid = self.cached(key)
+        if valid is None:
+            with SIGNATURE_SECONDS.time(mode='single'):
+                valid = check_sign(tx.sender, tx.recipient, tx.amount, tx.signature, tx.scheme)
+            SIGNATURES.inc(result='valid' if valid else 'invalid')
+            self.store(key, valid)
+        else:
+            SIGNATURES.inc(result='cached')
+        return valid
+
+    # Verify many transactions at once, unknown ones are spread over a process pool when there are enough of them.
+    # workers overrides the pool size of this verifier for one call.
+    def verify_many(self, txs, workers=None):
+        workers = workers or self.workers
+        keys = [self.tx_hash(tx) for tx in txs]
+        results = [self.cached(key) for key in keys]
+        missing = [idx for idx, valid in enumerate(results) if valid is None]
+        items = [(txs[idx].sender, txs[idx].recipient, txs[idx].amount, txs[idx].signature, txs[idx].scheme) for idx in missing]
+        SIGNATURES.inc(len(keys) - len(missing), result='cached')
+        if len(items) == 0:
+            return results
+        with SIGNATURE_SECONDS.time(mode='batch'):
+            if len(items) < BATCH_POOL_THRESHOLD or workers == 1:
+                checked = check_signs(items)
+            else:
+                chunk_size = -(-len(items) // workers)
+                with Pool(workers) as pool:
+                    checked = [valid for chunk in pool.map(check_signs, [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]) for valid in chunk]
+        valid_count = sum(1 for valid in checked if valid)
+        SIGNATURES.inc(valid_count, result='valid')
+        SIGNATURES.inc(len(checked) - valid_count, result='invalid')
+        for idx, valid in zip(missing, checked):
+            results[idx] = valid
+            self.store(keys[idx], valid)
+        return results
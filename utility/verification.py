@@ -1,26 +1,132 @@
+from multiprocessing import Pool, cpu_count
 from utility.hash_utils import hash_block, hash_string_256
+from utility.signature_verifier import check_sign
 from wallet import Wallet
+from block import LEGACY_VERSION, MERKLE_VERSION
+from utility.metrics import metrics
+
+# Runs with fewer (non reward) transactions than this are verified on one process, the pool costs more than it saves.
+PARALLEL_MIN_TRANSACTIONS = 256
+# More segments than workers keeps every worker busy when segments differ in cost, and lets a failure stop the rest sooner.
+SEGMENTS_PER_WORKER = 4
+
+VERIFY_BLOCKS_SECONDS = metrics.histogram('blockchain_verify_blocks_seconds', 'Time spent verifying a run of blocks (verify_chain, sync pages)')
+VERIFY_BLOCKS = metrics.counter('blockchain_verified_blocks_total', 'Blocks verified, by result')
+VERIFY_TX_SECONDS = metrics.histogram('blockchain_verify_tx_seconds', 'Time spent on verify_tx (balance and signature)', buckets=(0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05))
+
+# Everything about a segment of blocks that does not depend on balances: hash links, proof of work and signatures.
+# previous_block is the block before the segment, so links across segments are checked too.
+def check_segment(item):
+    difficulty, previous_block, blocks = item
+    for block in blocks:
+        if block.index != previous_block.index + 1 or block.previous_hash != hash_block(previous_block):
+            return False
+        if not Verification.valid_block_proof(block, difficulty):
+            return False
+        previous_block = block
+    return all(check_sign(tx.sender, tx.recipient, tx.amount, tx.signature, tx.scheme) for block in blocks for tx in block.transactions[:-1])
 
 class Verification:
 
+    # Everything a proof is hashed with except the proof itself.
     @staticmethod
-    def valid_proof(transactions, last_hash, proof, difficulty):
-        return hash_string_256((str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash) + str(proof)).encode())[:difficulty]==difficulty*'0'
+    def proof_prefix(transactions, last_hash):
+        return str([tx.to_ordered_dict() for tx in transactions]) + str(last_hash)
+
+    @classmethod
+    def valid_proof(cls, transactions, last_hash, proof, difficulty):
+        return hash_string_256((cls.proof_prefix(transactions, last_hash) + str(proof)).encode())[:difficulty]==difficulty*'0'
+
+    # Version 2 blocks prove work on their own hash, which covers the merkle root of every tx (reward included).
+    @classmethod
+    def valid_block_proof(cls, block, difficulty):
+        if block.version == MERKLE_VERSION:
+            return block.hash[:difficulty] == difficulty * '0'
+        if block.version == LEGACY_VERSION:
+            # The [:-1] is to skip the reward tx because the proof was calculated without it.
+            return cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof, difficulty)
+        return False
+
+    @classmethod
+    def verify_chain(cls, difficulty, chain, ledger, workers=None):
+        ledger.apply_block(chain[0])
+        return cls.verify_blocks(difficulty, chain[0], chain[1:], ledger, workers)
+
+    # Verify blocks that follow previous_block, the ledger must hold the balances as of previous_block.
+    # It is filled block by block so every tx is checked against the balances as of its own block.
+    # Long runs are verified on up to workers processes (all cores by default).
+    @classmethod
+    def verify_blocks(cls, difficulty, previous_block, blocks, ledger, workers=None):
+        workers = workers or cpu_count()
+        with VERIFY_BLOCKS_SECONDS.time():
+            if workers > 1 and sum(len(block.transactions) - 1 for block in blocks) >= PARALLEL_MIN_TRANSACTIONS:
+                valid = cls.__verify_blocks_parallel(difficulty, previous_block, blocks, ledger, workers)
+            else:
+                valid = cls.__verify_blocks(difficulty, previous_block, blocks, ledger, workers)
+        VERIFY_BLOCKS.inc(len(blocks), result='valid' if valid else 'invalid')
+        return valid
 
+    # Segments are checked on the pool in order while this process applies balances of the segments already checked.
+    # Leaving the pool on the first invalid segment or balance terminates the segments still running.
     @classmethod
-    def verify_chain(cls, get_balance, difficulty, chain):
-        chain_copy = chain[:]
-        for idx, block in enumerate(chain_copy):
-            if idx > 0:
-                if block.previous_hash != hash_block(chain_copy[idx-1]):
+    def __verify_blocks_parallel(cls, difficulty, previous_block, blocks, ledger, workers):
+        size = -(-len(blocks) // (workers * SEGMENTS_PER_WORKER))
+        items = [(difficulty, previous_block if i == 0 else blocks[i - 1], blocks[i:i + size]) for i in range(0, len(blocks), size)]
+        with Pool(workers) as pool:
+            for (_, _, segment), valid in zip(items, pool.imap(check_segment, items)):
+                if not valid or not cls.apply_balances(segment, ledger):
                     return False
-                if not cls.valid_proof(block.transactions[:-1], block.previous_hash, block.proof, difficulty):
+        return True
+
+    # The order dependent part, signatures must have been checked already.
+    @staticmethod
+    def apply_balances(blocks, ledger):
+        for block in blocks:
+            for tx in block.transactions[:-1]:
+                if ledger.get_balance(tx.sender) < tx.amount:
                     return False
-                if not all([Verification.verify_tx(tx, get_balance) for tx in block.transactions[:-1]]):
+                ledger.apply_tx(tx)
+            # The reward tx
+            for tx in block.transactions[-1:]:
+                ledger.apply_tx(tx)
+            ledger.commit(block.index)
+        return True
+
+    # Whether the ledger (as of the block before this one) funds every tx of the block, in order.
+    # The ledger is left untouched, only the balances the block changes are tracked.
+    @staticmethod
+    def funded(block, ledger):
+        changes = {}
+        for tx in block.transactions[:-1]:
+            if ledger.get_balance(tx.sender) + changes.get(tx.sender, 0) < tx.amount:
+                return False
+            changes[tx.sender] = changes.get(tx.sender, 0) - tx.amount
+            changes[tx.recipient] = changes.get(tx.recipient, 0) + tx.amount
+        return True
+
+    @classmethod
+    def __verify_blocks(cls, difficulty, previous_block, blocks, ledger, workers):
+        # Check every signature in one batch first, verify_tx below then hits the verified cache.
+        if not all(Wallet.verifty_tx_signs([tx for block in blocks for tx in block.transactions[:-1]], workers)):
+            return False
+        for block in blocks:
+            if block.index != previous_block.index + 1 or block.previous_hash != hash_block(previous_block):
+                return False
+            if not cls.valid_block_proof(block, difficulty):
+                return False
+            for tx in block.transactions[:-1]:
+                if not cls.verify_tx(tx, ledger.get_balance):
                     return False
+                ledger.apply_tx(tx)
+            # The reward tx
+            for tx in block.transactions[-1:]:
+                ledger.apply_tx(tx)
+            ledger.commit(block.index)
+            previous_block = block
         return True
 
     @staticmethod
     def verify_tx(tx, get_balance):
-        return get_balance(tx.sender) >= tx.amount and Wallet.verifty_tx_sign(tx)
+        with VERIFY_TX_SECONDS.time():
+            return get_balance(tx.sender) >= tx.amount and Wallet.verifty_tx_sign(tx)
         
\ No newline at end of file
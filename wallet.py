@@ -1,13 +1,27 @@
-from Cryptodome.PublicKey import RSA
+from Cryptodome.PublicKey import ECC, RSA
 import Cryptodome.Random as rand
 from Cryptodome.Hash import SHA256
 import binascii
 from Cryptodome.Signature import PKCS1_v1_5
+from transaction import RSA as RSA_SCHEME, ED25519, SCHEMES, Transaction
+from utility.signature_verifier import SignatureVerifier, import_ed25519_signer, signed_message
 
 # There is no verification for the keys when loaded!
+# Wallet files hold the public key, the private key and, for anything but RSA, the scheme on a third line.
 class Wallet:
-    def __init__(self, node_id):
+    # Shared by every check so parsed keys and verified transactions are reused.
+    verifier = SignatureVerifier()
+
+    # randfunc is only for reproducible keys (e.g. benchmarks), it defaults to the OS randomness.
+    # scheme is only used when a new wallet is generated, an existing wallet file keeps its own.
+    def __init__(self, node_id, randfunc=None, scheme=RSA_SCHEME):
+        if scheme not in SCHEMES:
+            raise ValueError(f'Unknown signature scheme {scheme}')
         self.node_id = node_id
+        self.randfunc = randfunc
+        self.scheme = scheme
+        self.signer = None
+        self.signer_key = None
         self.load_keys()
 
     def save_keys(self):
@@ -15,12 +29,16 @@ class Wallet:
             f.write(self.public_key)
             f.write('\n')
             f.write(self.private_key)
+            if self.scheme != RSA_SCHEME:
+                f.write('\n')
+                f.write(self.scheme)
 
     def load_keys(self):
         try:
             with open(f'wallet-{self.node_id}.txt', mode='r') as f:
                 keys = f.readlines()
-                self.public_key, self.private_key = keys[0][:-1], keys[1] # The [:-1] is to skip the \n
+                self.public_key, self.private_key = keys[0][:-1], keys[1].rstrip('\n') # The [:-1] is to skip the \n
+                self.scheme = keys[2].strip() if len(keys) > 2 and keys[2].strip() in SCHEMES else RSA_SCHEME
         except (IOError, IndexError):
             self.private_key, self.public_key = self.generate_keys()
             self.public_key = self.public_key
@@ -28,21 +46,48 @@ class Wallet:
             print('Failed to find wallet, generated new wallet file.')
 
     def generate_keys(self):
-        private_key = RSA.generate(1024, rand.new().read)
+        randfunc = self.randfunc or rand.new().read
+        if self.scheme == ED25519:
+            private_key = ECC.generate(curve='Ed25519', randfunc=randfunc)
+            return (
+                binascii.hexlify(private_key.export_key(format='DER')).decode('ascii'),
+                binascii.hexlify(private_key.public_key().export_key(format='raw')).decode('ascii'),
+            )
+        private_key = RSA.generate(1024, randfunc)
         return (
             binascii.hexlify(private_key.exportKey(format='DER')).decode('ascii'),
             binascii.hexlify(private_key.publickey().exportKey(format='DER')).decode('ascii'),
         )
-    
+
+    # The parsed private key is kept, it is only parsed again if the key itself changed.
+    def get_signer(self):
+        if self.signer is None or self.signer_key != self.private_key:
+            key = binascii.unhexlify(self.private_key)
+            if self.scheme == ED25519:
+                self.signer = import_ed25519_signer(key)
+            else:
+                self.signer = PKCS1_v1_5.new(RSA.importKey(key))
+            self.signer_key = self.private_key
+        return self.signer
+
     def sign_tx(self, sender, recipient, amount):
-        signer = PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(self.private_key)))
-        h = SHA256.new((str(sender) + str(recipient) + str(amount)).encode('utf8'))
-        signature = signer.sign(h)
+        message = signed_message(sender, recipient, amount)
+        signature = self.get_signer().sign(message if self.scheme == ED25519 else SHA256.new(message))
         return binascii.hexlify(signature).decode('ascii')
 
-    @staticmethod
-    def verifty_tx_sign(tx):
-        public_key = RSA.importKey(binascii.unhexlify(tx.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(tx.sender) + str(tx.recipient) + str(tx.amount)).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(tx.signature))
\ No newline at end of file
+    # Sign many (sender, recipient, amount) at once, the signatures are in the same order.
+    def sign_txs(self, items):
+        return [self.sign_tx(sender, recipient, amount) for sender, recipient, amount in items]
+
+    # Transactions from this wallet for every (recipient, amount), signed and tagged with the wallet's scheme.
+    def create_txs(self, payments):
+        signatures = self.sign_txs([(self.public_key, recipient, amount) for recipient, amount in payments])
+        return [Transaction(self.public_key, recipient, signature, amount, self.scheme) for (recipient, amount), signature in zip(payments, signatures)]
+
+    @classmethod
+    def verifty_tx_sign(cls, tx):
+        return cls.verifier.verify(tx)
+
+    @classmethod
+    def verifty_tx_signs(cls, txs, workers=None):
+        return cls.verifier.verify_many(txs, workers)